@@ -1,20 +1,50 @@
-from sqlalchemy import Column, String, Integer, ForeignKey, Float, CHAR, Boolean, DateTime, Text, or_
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy import Column, String, Integer, ForeignKey, Float, CHAR, Boolean, Date, DateTime, Text, Index, and_, or_, inspect, text, func, cast
+from sqlalchemy.orm import relationship, backref, object_mapper
+from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.ext.declarative import declarative_base
 from os import path
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.sql.expression import select, exists
+from sqlalchemy.sql.expression import select, exists, bindparam, literal, union_all
+from sqlalchemy import MetaData
+import collections
 import datetime
+import functools
+import hashlib
+import heapq
+import itertools
+import logging
+import multiprocessing
+import numbers
+import time
+import threading
+import types
+import uuid
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
+from multiprocessing.pool import ThreadPool
+import os
+from contextlib import contextmanager
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool, StaticPool
+from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 
 Base = declarative_base()
 
+# progress of the bulk functions (AddEvents, RegisterDirectory) is logged here at INFO, not printed
+log = logging.getLogger('DBlib')
+
 
 ################################ Classes ################################
 
 class AnimalChannelList(Base):
     __tablename__ = 'AnimalChannelList'
+    __table_args__ = (Index('ix_AnimalChannelList_channel', 'channel'),
+                      Index('ix_AnimalChannelList_compound_animal', 'compound_animal'))
     id = Column(Integer, primary_key=True)
     compound_animal = Column(String)
     channel = Column(String)
@@ -22,6 +52,8 @@ class AnimalChannelList(Base):
 
 class DataFiles(Base):
     __tablename__ = 'DataFiles'
+    # animal is the leading primary key column, so only file_name lookups need their own index
+    __table_args__ = (Index('ix_DataFiles_file_name_animal', 'file_name', 'animal'),)
     animal = Column(String, primary_key=True)
     file_name = Column(String, primary_key=True)
                     # filename of the EEG file containing this animal/seizure
@@ -35,10 +67,14 @@ class DataFiles(Base):
     sample_freq = Column(Integer)
     file_length = Column(Integer)
     video_file_path = Column(String)
+    file_size = Column(Integer)
+    file_mtime = Column(Float)
+                    # size and modification time when registered, so RegisterDirectory can skip unchanged files
     reviewed = Column(Boolean, unique=False, default=False)
 
 class unusedDataFiles(Base):
     __tablename__ = 'unusedDataFiles'
+    __table_args__ = (Index('ix_unusedDataFiles_file_name_animal', 'file_name', 'animal'),)
     animal = Column(String, primary_key=True)
     file_name = Column(String, primary_key=True)
                     # filename of the EEG file containing this animal/seizure
@@ -52,6 +88,11 @@ class unusedDataFiles(Base):
     sample_freq = Column(Integer)
     file_length = Column(Integer)
     video_file_path = Column(String)
+    file_size = Column(Integer)
+    file_mtime = Column(Float)
+                    # size and modification time when registered, so RegisterDirectory can skip unchanged files
+    reviewed = Column(Boolean, unique=False, default=False)
+                    # kept here too so the flag survives MoveAnimals in both directions
 
 class AlgorithmParameters(Base):
     __tablename__ = 'AlgorithmParameters'
@@ -106,6 +147,10 @@ class Events(Base):
     #       event_start
     #       animal
     #       filename
+    # (animal, filename) filters are served by the key; filename on its own needs an index.
+    # Absolute-time window queries range over (animal, abs_start) and read abs_end from the index
+    __table_args__ = (Index('ix_Events_filename', 'filename'),
+                      Index('ix_Events_animal_abs_start', 'animal', 'abs_start', 'abs_end'))
     animal = Column(String, primary_key=True)
                     # 'name' of the animal/channel, or channel label in acq
     filename = Column(String, primary_key=True)
@@ -129,32 +174,995 @@ class Events(Base):
                     # either manually or automatically (man/auto)
     edit_status = Column(CHAR)
                     # edit status can be 'a' appended, 'j' joined, 'd' deleted, 'e' edited
+    abs_start = Column(Float)
+                    # file_start + event_start, in seconds since 1970-01-01 (file_start is naive local time)
+    abs_end = Column(Float)
+                    # file_start + event_end, same clock as abs_start
+    param_version = Column(String)
+                    # ParameterVersion of the AlgorithmParameters the detector ran with; None for manual events
 
+# each animal's longest event, which bounds the time-window queries, is one probe of this index
+Index('ix_Events_animal_duration', Events.animal, Events.event_end - Events.event_start)
 
-################################ Functions ################################
 
-def CreateDB(DBStr=None):
-   # def execute(self):
+class DetectionRuns(Base):
+    __tablename__ = 'DetectionRuns'
+    # one row per file the detector has been through with one parameter set, whether it found events
+    # or not; FilesToDetect reads it. The key order serves its (animal, param_version) lookup
+    animal = Column(String, primary_key=True)
+    param_version = Column(String, primary_key=True)
+                    # ParameterVersion of the AlgorithmParameters the detector ran with
+    filename = Column(String, primary_key=True)
 
-    engine = create_engine(DBStr)
 
-    session = sessionmaker()
-    session.configure(bind=engine)
-    Base.metadata.create_all(engine)
+# kept out of Base so create_all leaves it alone: the daily summary only exists in databases that
+# have asked for it with EnableDailySummary
+_SummaryBase = declarative_base()
 
-    engine.dispose()
+class DailySeizureSummary(_SummaryBase):
+    __tablename__ = 'DailySeizureSummary'
+    # one row per animal per day (of abs_start) that has events; events marked 'd' are not counted
+    animal = Column(String, primary_key=True)
+    day = Column(Date, primary_key=True)
+    n_events = Column(Integer)
+    total_duration = Column(Float)
+                    # seconds; an event with no event_end counts as zero length
+    n_scored = Column(Integer)
+                    # events that have a racine_score
+    racine_total = Column(Integer)
+    max_racine = Column(Integer)
+
+
+################################ Engine registry ################################
+
+# one engine (and its connection pool) per DBStr for the life of the process, so the
+# public functions below no longer pay for connect + create_all + dispose on every call
+_registry_lock = threading.RLock()
+_engines = {}
+_session_factories = {}
+_read_engines = {}
+_read_session_factories = {}
+_schema_checked = set()
+_connection_profiles = {}
+_engine_dbstrs = {}
+
+# connection profile for several processes sharing one SQLite file (review GUI plus detectors):
+# WAL lets readers carry on while a writer commits, synchronous=NORMAL drops the fsync per commit
+# (still crash-safe under WAL), and the busy timeout makes writers queue instead of failing with
+# 'database is locked'. cache_size is negative, i.e. KiB; busy_timeout is in ms
+CONCURRENT_PROFILE = {'journal_mode': 'WAL',
+                      'synchronous': 'NORMAL',
+                      'mmap_size': 256 * 1024 * 1024,
+                      'cache_size': -64 * 1024,
+                      'busy_timeout': 30000}
+
+_PROFILE_PRAGMAS = ('journal_mode', 'synchronous', 'mmap_size', 'cache_size', 'busy_timeout')
+
+
+def _IsSqliteFile(DBStr):
+    url = make_url(DBStr)
+    return url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:')
+
+
+def _EngineArgs(DBStr):
+    url = make_url(DBStr)
+    if url.get_backend_name() != 'sqlite':
+        return {'pool_pre_ping': True}
+    if url.database in (None, '', ':memory:'):
+        # an in-memory database only lives as long as its connection, so everyone shares one
+        return {'poolclass': StaticPool, 'connect_args': {'check_same_thread': False}}
+    connect_args = {'check_same_thread': False}
+    profile = _connection_profiles.get(DBStr)
+    if profile and 'busy_timeout' in profile:
+        connect_args['timeout'] = profile['busy_timeout'] / 1000.0
+    return {'poolclass': QueuePool, 'connect_args': connect_args}
+
+
+def _ApplyConnectionProfile(engine, profile, readOnly=False):
+    # pragmas run on every new pooled connection; readers skip journal_mode (it is stored in the
+    # file, so the writer's setting already holds) and are locked down with query_only
+    def on_connect(dbapi_conn, connection_record):
+        cursor = dbapi_conn.cursor()
+        for name in _PROFILE_PRAGMAS:
+            if name in (profile or {}) and not (readOnly and name == 'journal_mode'):
+                cursor.execute('PRAGMA %s=%s' % (name, profile[name]))
+        if readOnly:
+            cursor.execute('PRAGMA query_only=ON')
+        cursor.close()
+    event.listen(engine, 'connect', on_connect)
+
+
+def SetConnectionProfile(DBStr=None, profile=None):
+    # pragmas for every connection to the SQLite file DBStr, e.g. CONCURRENT_PROFILE; None restores
+    # the driver defaults. Pooled connections are dropped so the next call picks the profile up
+    with _registry_lock:
+        if profile is None:
+            _connection_profiles.pop(DBStr, None)
+        else:
+            _connection_profiles[DBStr] = dict(profile)
+        DisposeEngine(DBStr)
+
+
+def GetEngine(DBStr=None):
+    with _registry_lock:
+        engine = _engines.get(DBStr)
+        if engine is None:
+            engine = create_engine(DBStr, **_EngineArgs(DBStr))
+            if _IsSqliteFile(DBStr) and DBStr in _connection_profiles:
+                _ApplyConnectionProfile(engine, _connection_profiles[DBStr])
+            _engines[DBStr] = engine
+            _engine_dbstrs[engine] = DBStr
+            # objects handed back to callers outlive the session, so don't expire them on commit
+            _session_factories[DBStr] = sessionmaker(bind=engine, expire_on_commit=False)
+        if DBStr not in _schema_checked:
+            Base.metadata.create_all(engine)
+            added = _AddMissingColumns(engine)
+            if ('Events', 'abs_start') in added:
+                _BackfillAbsoluteTimes(engine)
+            _schema_checked.add(DBStr)
+    return engine
+
+
+def _AddMissingColumns(engine):
+    # databases created before a column was added to a model get it via ALTER TABLE, so older
+    # files keep working with the current classes; a column with a constant default gets it on the
+    # existing rows too. Returns the (table, column) pairs added
+    inspector = inspect(engine)
+    added = []
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = set(col['name'] for col in inspector.get_columns(table.name))
+            for col in table.columns:
+                if col.name not in existing:
+                    ddl = 'ALTER TABLE "%s" ADD COLUMN "%s" %s' % (table.name, col.name,
+                                                                   col.type.compile(dialect=engine.dialect))
+                    if col.default is not None and col.default.is_scalar:
+                        ddl += ' DEFAULT %s' % literal(col.default.arg, col.type).compile(
+                            dialect=engine.dialect, compile_kwargs={'literal_binds': True})
+                    conn.execute(text(ddl))
+                    added.append((table.name, col.name))
+    return added
+
+
+def _BackfillAbsoluteTimes(engine):
+    # one UPDATE per distinct file_start rather than per event
+    events = Events.__table__
+    with engine.begin() as conn:
+        file_starts = [row[0] for row in conn.execute(select([events.c.file_start]).distinct())
+                       if row[0] is not None]
+        for file_start in file_starts:
+            offset = _EpochSeconds(file_start)
+            conn.execute(events.update().where(events.c.file_start == file_start).values(
+                abs_start=events.c.event_start + offset, abs_end=events.c.event_end + offset))
+
+
+def GetReadEngine(DBStr=None):
+    # separate pool of query_only connections for the read functions, so a reader never holds (or
+    # waits on) a connection the writers need. Only SQLite files get one; otherwise it's GetEngine
+    engine = GetEngine(DBStr)
+    if not _IsSqliteFile(DBStr):
+        return engine
+    with _registry_lock:
+        read_engine = _read_engines.get(DBStr)
+        if read_engine is None:
+            read_engine = create_engine(DBStr, **_EngineArgs(DBStr))
+            _ApplyConnectionProfile(read_engine, _connection_profiles.get(DBStr), readOnly=True)
+            _read_engines[DBStr] = read_engine
+            _read_session_factories[DBStr] = sessionmaker(bind=read_engine, expire_on_commit=False)
+    return read_engine
+
+
+@contextmanager
+def DbSession(DBStr=None, thisSession=None, readOnly=False):
+    # session from the shared pool: commits on a clean exit, rolls back on error, always closes.
+    # If the caller already has a session it is passed straight through and left for them to manage.
+    # readOnly sessions come from GetReadEngine's pool and cannot write
+    if thisSession is not None:
+        yield thisSession
+        return
+    frame = _ProfiledFrame()
+    if frame is not None:
+        start, sql_start = time.time(), frame.sql_s
+    if readOnly and GetReadEngine(DBStr) is not _engines[DBStr]:
+        s = _read_session_factories[DBStr]()
+    else:
+        GetEngine(DBStr)
+        s = _session_factories[DBStr]()
+    if frame is not None:
+        # connect now rather than at the first query, so that checkout is timed along with engine setup
+        s.connection()
+        _ChargeTime(frame, 'setup_s', start, sql_start)
+    try:
+        yield s
+        frame = _ProfiledFrame()
+        if frame is not None:
+            start, sql_start = time.time(), frame.sql_s
+        s.commit()
+        if frame is not None:
+            _ChargeTime(frame, 'commit_s', start, sql_start)
+    except:
+        s.rollback()
+        raise
+    finally:
+        s.close()
 
-def EntryExists(DBStr=None, thisSession=None, thisDataFile=None, thisFileName=None, unusedDataFlag=True, AlgPars = None, thisEvent=None):
 
-    if not thisSession:
-        engine = create_engine(DBStr)
+def DisposeEngine(DBStr=None):
+    # release pooled connections for one database, or for every database if DBStr is None
+    with _registry_lock:
+        if DBStr is None:
+            keys = list(_engines.keys())
+        else:
+            keys = [DBStr] if DBStr in _engines else []
+        for key in keys:
+            engine = _engines.pop(key)
+            _engine_dbstrs.pop(engine, None)
+            engine.dispose()
+            _session_factories.pop(key, None)
+            probe = _data_version_conns.pop(key, None)
+            if probe is not None:
+                with probe[1]:
+                    probe[0].close()
+            if key in _read_engines:
+                _read_engines.pop(key).dispose()
+                _read_session_factories.pop(key, None)
+            _schema_checked.discard(key)
+            _metadata_cache.pop(key, None)
+            _cache_versions.pop(key, None)
+
+
+################################ Metadata cache ################################
+
+# per-database cache of the small lookups the GUI asks for on every refresh (distinct animals,
+# files, channels, channel -> compound animal). Entries are tagged with the table they were read
+# from and dropped whenever a DBlib write to that table commits. For SQLite files every lookup also
+# checks PRAGMA data_version, and the whole cache is dropped once anyone else, e.g. a detector
+# process, has committed to the file
+_metadata_cache = {}
+_cache_generation = {}
+_cache_versions = {}
+_data_version_conns = {}
+
+
+def _DataVersion(DBStr):
+    # PRAGMA data_version changes whenever another connection commits, but it is only comparable on one
+    # connection, so a pooled read connection is kept aside for asking it. None if DBStr isn't a file
+    if not _IsSqliteFile(DBStr):
+        return None
+    with _registry_lock:
+        probe = _data_version_conns.get(DBStr)
+        if probe is None:
+            probe = _data_version_conns[DBStr] = (GetReadEngine(DBStr).raw_connection(), threading.Lock())
+    conn, lock = probe
+    with lock:
+        cursor = conn.cursor()
+        try:
+            cursor.execute('PRAGMA data_version')
+            return cursor.fetchone()[0]
+        finally:
+            cursor.close()
+
+
+def _CachedLookup(DBStr, tableName, key, loader):
+    version = _DataVersion(DBStr)
+    with _registry_lock:
+        if _cache_versions.get(DBStr) != version:
+            _metadata_cache.pop(DBStr, None)
+            _cache_versions[DBStr] = version
+        entries = _metadata_cache.setdefault(DBStr, {})
+        if (tableName, key) in entries:
+            return entries[(tableName, key)]
+        generation = _cache_generation.get(DBStr, 0)
+    value = loader()
+    with _registry_lock:
+        # a write that committed while we were loading makes this value stale, so don't keep it
+        if _cache_generation.get(DBStr, 0) == generation and _cache_versions.get(DBStr) == version:
+            _metadata_cache.setdefault(DBStr, {})[(tableName, key)] = value
+    return value
+
+
+def InvalidateCache(DBStr=None, *tableNames):
+    # drop cached lookups for the given tables of DBStr (all tables if none given, all databases if DBStr is None)
+    with _registry_lock:
+        if DBStr is None:
+            _metadata_cache.clear()
+            for key in list(_cache_generation.keys()):
+                _cache_generation[key] += 1
+            return
+        _cache_generation[DBStr] = _cache_generation.get(DBStr, 0) + 1
+        entries = _metadata_cache.get(DBStr, {})
+        for cache_key in list(entries.keys()):
+            if not tableNames or cache_key[0] in tableNames:
+                del entries[cache_key]
+
+
+def _MarkWritten(s, *tables, **kwargs):
+    # called by the write functions; the cache is cleared now and again once the session commits,
+    # so a lookup that races an uncommitted caller-owned session can't leave stale values behind.
+    # animals=[...] says the write only touched those animals' rows, so snapshots reload just them
+    names = set(table.__tablename__ for table in tables)
+    s.info.setdefault('dblib_written', set()).update(names)
+    animals = kwargs.get('animals')
+    snapshot_written = s.info.setdefault('dblib_snapshot_written', {})
+    for name in names:
+        if animals is None or (name in snapshot_written and snapshot_written[name] is None):
+            snapshot_written[name] = None
+        else:
+            snapshot_written.setdefault(name, set()).update(animals)
+    _InvalidateBind(s.get_bind(), names)
+
+
+def _RegisterEngine(DBStr, engine):
+    # commits on an engine DBlib didn't make itself (DBlib_async's) still have to clear DBStr's cache
+    # and refresh its snapshot, which both find the database from the engine the session was bound to
+    with _registry_lock:
+        _engine_dbstrs[engine] = DBStr
+
+
+def _InvalidateBind(engine, tableNames):
+    DBStr = _engine_dbstrs.get(engine)
+    if DBStr is not None:
+        InvalidateCache(DBStr, *tableNames)
+
+
+@event.listens_for(Session, 'after_commit')
+def _InvalidateOnCommit(s):
+    written = s.info.pop('dblib_written', None)
+    if written:
+        _InvalidateBind(s.get_bind(), written)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _ForgetWrites(s):
+    s.info.pop('dblib_written', None)
+    s.info.pop('dblib_snapshot_written', None)
+
+
+################################ Profiling ################################
+
+# opt-in instrumentation: EnableProfiling() turns on per-function counters fed by SQLAlchemy engine
+# events, GetProfileStats() reads them. While disabled the hooks cost one dict lookup per call
+_profile_settings = {'enabled': False, 'slow_query_s': None, 'n_plus_one': 20}
+_profile_lock = threading.Lock()
+_profile_stats = {}
+_statement_counts = {}
+_slow_queries = collections.deque(maxlen=200)
+_profile_local = threading.local()
+slow_query_log = logging.getLogger('DBlib.slowquery')
+
+# functions called one row at a time that have a set-based replacement, for GetProfileStats' bulk_candidates
+_BULK_ALTERNATIVES = {'AddToDb': 'AddEvents',
+                      'EntryExists': 'EntriesExist',
+                      'UpdateDb': 'UpdateDataFiles'}
+
+
+def EnableProfiling(slowQueryThreshold=None, nPlusOneThreshold=20):
+    # slowQueryThreshold (seconds): statements at least this slow are logged to the 'DBlib.slowquery'
+    # logger and kept for GetProfileStats. nPlusOneThreshold: a SELECT that one DBlib function issues
+    # more than once per call, and at least this many times in all, is reported as an N+1 pattern; a
+    # function with a bulk alternative called this many times is reported as a bulk candidate
+    _profile_settings['slow_query_s'] = slowQueryThreshold
+    _profile_settings['n_plus_one'] = nPlusOneThreshold
+    _profile_settings['enabled'] = True
+
+
+def DisableProfiling():
+    _profile_settings['enabled'] = False
+
+
+def ResetProfileStats():
+    with _profile_lock:
+        _profile_stats.clear()
+        _statement_counts.clear()
+        _slow_queries.clear()
+
+
+def GetProfileStats():
+    # {'functions': {name: counters}, 'n_plus_one': [...], 'bulk_candidates': [...], 'slow_queries': [...]}.
+    # Per call, sql_s is time in cursor.execute, setup_s getting the engine and a pooled connection,
+    # commit_s the commit, and python_s the rest: row fetching, ORM hydration and other Python-side work
+    threshold = _profile_settings['n_plus_one']
+    with _profile_lock:
+        functions = dict((name, dict(counters)) for name, counters in _profile_stats.items())
+        n_plus_one = []
+        for (name, statement), executions in _statement_counts.items():
+            calls = functions.get(name, {}).get('calls', 0)
+            # the same SELECT over and over across separate calls is just a function called often
+            if executions >= threshold and executions > calls:
+                n_plus_one.append({'function': name, 'statement': statement, 'executions': executions,
+                                   'calls': calls})
+        slow_queries = list(_slow_queries)
+    for counters in functions.values():
+        counters['python_s'] = max(counters['wall_s'] - counters['sql_s'] - counters['setup_s'] -
+                                   counters['commit_s'], 0.0)
+    n_plus_one.sort(key=lambda entry: -entry['executions'])
+    bulk_candidates = sorted(({'function': name, 'calls': functions[name]['calls'], 'bulk_alternative': bulk}
+                              for name, bulk in _BULK_ALTERNATIVES.items()
+                              if functions.get(name, {}).get('calls', 0) >= threshold),
+                             key=lambda entry: -entry['calls'])
+    return {'functions': functions, 'n_plus_one': n_plus_one, 'bulk_candidates': bulk_candidates,
+            'slow_queries': slow_queries}
+
+
+class _CallFrame(object):
+    __slots__ = ('name', 'statements', 'sql_s', 'setup_s', 'commit_s')
+
+    def __init__(self, name):
+        self.name = name
+        self.statements = 0
+        self.sql_s = 0.0
+        self.setup_s = 0.0
+        self.commit_s = 0.0
+
+
+def _CallStack():
+    stack = getattr(_profile_local, 'stack', None)
+    if stack is None:
+        stack = _profile_local.stack = []
+    return stack
+
+
+def _ProfiledFrame():
+    # the innermost profiled call on this thread, or None when profiling is off
+    if not _profile_settings['enabled']:
+        return None
+    stack = _CallStack()
+    return stack[-1] if stack else None
+
+
+def _ChargeTime(frame, field, start, sql_start):
+    # wall time since start, less the SQL run meanwhile (sql_s has that already), goes to frame's field
+    elapsed = time.time() - start - (frame.sql_s - sql_start)
+    setattr(frame, field, getattr(frame, field) + max(elapsed, 0.0))
+
+
+def _CountRows(result):
+    if result is None or isinstance(result, bool):
+        return 0
+    if isinstance(result, numbers.Integral):
+        return result
+    try:
+        return len(result)
+    except TypeError:
+        return 0
+
+
+def _RecordCall(frame, wall_s, rows, calls=1):
+    with _profile_lock:
+        counters = _profile_stats.setdefault(frame.name, {'calls': 0, 'statements': 0, 'sql_s': 0.0, 'setup_s': 0.0,
+                                                          'commit_s': 0.0, 'wall_s': 0.0, 'rows': 0})
+        counters['calls'] += calls
+        counters['statements'] += frame.statements
+        counters['sql_s'] += frame.sql_s
+        counters['setup_s'] += frame.setup_s
+        counters['commit_s'] += frame.commit_s
+        counters['wall_s'] += wall_s
+        counters['rows'] += rows
+
+
+def _Profiled(fn):
+    # wraps a public DBlib function so statements run underneath it are charged to it
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not _profile_settings['enabled']:
+            return fn(*args, **kwargs)
+        frame = _CallFrame(fn.__name__)
+        stack = _CallStack()
+        stack.append(frame)
+        start = time.time()
+        result = None
+        try:
+            result = fn(*args, **kwargs)
+        finally:
+            stack.pop()
+            streaming = isinstance(result, types.GeneratorType)
+            _RecordCall(frame, time.time() - start, 0 if streaming else _CountRows(result))
+        if streaming:
+            return _ProfiledGenerator(fn.__name__, result)
+        return result
+    return wrapper
+
+
+def _ProfiledGenerator(name, rows):
+    # streaming readers run their SQL while being consumed, so each step is charged to name as well
+    stack = _CallStack()
+    while True:
+        frame = _CallFrame(name)
+        stack.append(frame)
+        start = time.time()
+        try:
+            row = next(rows)
+        except StopIteration:
+            return
+        finally:
+            stack.pop()
+            _RecordCall(frame, time.time() - start, 0, calls=0)
+        _RecordCall(_CallFrame(name), 0.0, 1, calls=0)
+        yield row
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _BeforeCursorExecute(conn, cursor, statement, parameters, context, executemany):
+    if _profile_settings['enabled']:
+        conn.info.setdefault('dblib_query_start', []).append(time.time())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _AfterCursorExecute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('dblib_query_start')
+    if not _profile_settings['enabled'] or not starts:
+        return
+    elapsed = time.time() - starts.pop()
+    stack = _CallStack()
+    name = stack[-1].name if stack else None
+    if stack:
+        stack[-1].statements += 1
+        stack[-1].sql_s += elapsed
+    if not executemany and statement.lstrip().upper().startswith('SELECT'):
+        with _profile_lock:
+            _statement_counts[(name, statement)] = _statement_counts.get((name, statement), 0) + 1
+    threshold = _profile_settings['slow_query_s']
+    if threshold is not None and elapsed >= threshold:
+        with _profile_lock:
+            _slow_queries.append({'function': name, 'statement': statement, 'seconds': elapsed})
+        slow_query_log.warning('%.3f s in %s: %s', elapsed, name, statement)
+
+
+################################ Snapshots ################################
+
+# in-memory copy of a database for the review GUI: the catalog tables in full plus the Events of the
+# animals being reviewed, held as detached ORM objects in dicts keyed like the read functions' filters.
+# FindInDb, GetAllChans, GetAllFiles, GetAllSeizures and EntryExists answer from it when it has what
+# they need. Writes still go to the file, and every DBlib write that commits in this process reloads
+# the rows it touched (only the animals it names, when it names them)
+_SNAPSHOT_INDEXES = collections.OrderedDict([(DataFiles, ('animal', 'file_name')),
+                                             (unusedDataFiles, ('animal', 'file_name')),
+                                             (AnimalChannelList, ('channel', 'compound_animal')),
+                                             (AlgorithmParameters, ('animal',)),
+                                             (Events, ('animal',))])
+_snapshots = {}
+# set by CheckQueryPlans on its own thread, so that the calls it inspects go to the database
+_snapshot_local = threading.local()
+
+
+def _LoadIntoSnapshot(DBStr, snapshot, thisTable, animals=None):
+    # (re)load thisTable's rows from disk, all of them or only those of animals
+    if thisTable is Events:
+        animals = snapshot['animals'] if animals is None else snapshot['animals'] & set(animals)
+        if not animals:
+            return
+    if not hasattr(thisTable, 'animal'):
+        animals = None
+    key_names = _KeyNames(thisTable)
+    objs = []
+    with DbSession(DBStr, readOnly=True) as s:
+        if animals is None:
+            objs = s.query(thisTable).all()
+        else:
+            animals = list(animals)
+            for i in range(0, len(animals), _MAX_SQL_PARAMS):
+                objs += s.query(thisTable).filter(thisTable.animal.in_(animals[i:i + _MAX_SQL_PARAMS])).all()
+
+    fields = _SNAPSHOT_INDEXES[thisTable]
+    with snapshot['lock']:
+        indexes = snapshot['indexes'][thisTable]
+        if animals is None:
+            for field in fields:
+                indexes[field] = {}
+        else:
+            for animal in animals:
+                for pk, obj in indexes['animal'].pop(animal, {}).items():
+                    for field in fields[1:]:
+                        indexes[field].get(getattr(obj, field), {}).pop(pk, None)
+        for obj in objs:
+            pk = tuple(getattr(obj, name) for name in key_names)
+            for field in fields:
+                indexes[field].setdefault(getattr(obj, field), {})[pk] = obj
+        for cache_key in [cache_key for cache_key in snapshot['sorted'] if cache_key[0] is thisTable]:
+            del snapshot['sorted'][cache_key]
+
+
+def _SnapshotRows(DBStr, thisTable, field, value):
+    # the snapshot's rows of thisTable with field == value, in primary key order (the order the disk
+    # queries return them in), or None when there is no snapshot of DBStr that holds them
+    snapshot = _snapshots.get(DBStr)
+    if snapshot is None or getattr(_snapshot_local, 'bypass', False) or \
+            (thisTable is Events and value not in snapshot['animals']):
+        return None
+    with snapshot['lock']:
+        rows = snapshot['sorted'].get((thisTable, field, value))
+        if rows is None:
+            bucket = snapshot['indexes'][thisTable][field].get(value, {})
+            rows = [bucket[pk] for pk in sorted(bucket)]
+            snapshot['sorted'][(thisTable, field, value)] = rows
+    return list(rows)
+
+
+def _FindInSnapshot(DBStr, thisTable, thisFilename, thisAnimal, thisCompoundAnimal):
+    # FindInDb's queries against the snapshot; None means ask the database
+    entry_query = None
+    if thisTable == 'Events':
+        entry_query = _SnapshotRows(DBStr, Events, 'animal', thisAnimal)
+        if entry_query is not None:
+            entry_query = [row for row in entry_query if row.filename == path.basename(thisFilename)]
+    if thisTable == 'unusedDataFiles':
+        entry_query = _SnapshotRows(DBStr, unusedDataFiles, 'animal', thisAnimal)
+    if thisTable == 'DataFiles':
+        entry_query = _SnapshotRows(DBStr, DataFiles, 'animal', thisAnimal)
+        if entry_query is not None and thisAnimal != None:
+            entry_query = [row for row in entry_query if row.file_name == path.basename(thisFilename)]
+    if thisTable == 'AnimalChannelList' and thisAnimal != None:
+        entry_query = _SnapshotRows(DBStr, AnimalChannelList, 'channel', thisAnimal)
+        # FindInDb uses .one() here; leave the no-match and many-match errors to it
+        entry_query = entry_query[0] if entry_query is not None and len(entry_query) == 1 else None
+    if thisTable == 'AnimalChannelList' and thisCompoundAnimal != None:
+        entry_query = _SnapshotRows(DBStr, AnimalChannelList, 'compound_animal', thisCompoundAnimal)
+    return entry_query
+
+
+def _ExistsInSnapshot(DBStr, thisDataFile, thisFileName, unusedDataFlag, AlgPars, thisEvent):
+    # EntryExists's checks against the snapshot; None means ask the database
+    thisTable = unusedDataFiles if unusedDataFlag else DataFiles
+    if thisFileName != None:
+        rows = _SnapshotRows(DBStr, thisTable, 'file_name', path.basename(str(thisFileName)))
+    elif thisDataFile != None:
+        rows = _SnapshotRows(DBStr, thisTable, 'file_name', path.basename(str(thisDataFile[0])))
+        if rows is not None:
+            rows = [row for row in rows if row.animal == thisDataFile[1].name]
+    elif AlgPars != None:
+        rows = _SnapshotRows(DBStr, AlgorithmParameters, 'animal', AlgPars[0])
+    elif thisEvent != None:
+        rows = _SnapshotRows(DBStr, Events, 'animal', thisEvent.Animal)
+        if rows is not None:
+            rows = [row for row in rows if row.event_start == thisEvent.Start and
+                    row.filename == path.basename(thisEvent.FileName)]
+    else:
+        return None
+    return None if rows is None else len(rows) > 0
+
+
+@_Profiled
+def OpenSnapshot(DBStr=None, eventAnimals=None):
+    # loads DataFiles, unusedDataFiles, AnimalChannelList, AlgorithmParameters and the Events of
+    # eventAnimals into memory; opening again replaces the snapshot. The objects handed back are
+    # shared between calls, so treat them as read-only. Writes made by other processes only show
+    # up after RefreshSnapshot
+    snapshot = {'animals': frozenset(eventAnimals or ()), 'sorted': {}, 'lock': threading.RLock(),
+                'indexes': dict((thisTable, dict((field, {}) for field in fields))
+                                for thisTable, fields in _SNAPSHOT_INDEXES.items())}
+    for thisTable in _SNAPSHOT_INDEXES:
+        _LoadIntoSnapshot(DBStr, snapshot, thisTable)
+    with _registry_lock:
+        _snapshots[DBStr] = snapshot
+
+
+@_Profiled
+def RefreshSnapshot(DBStr=None, *tableNames):
+    # reload the given tables (all of them if none given) from disk, e.g. after another process wrote
+    snapshot = _snapshots.get(DBStr)
+    if snapshot is not None:
+        for thisTable in [_TABLES[name] for name in tableNames] or list(_SNAPSHOT_INDEXES):
+            _LoadIntoSnapshot(DBStr, snapshot, thisTable)
+
+
+@_Profiled
+def CloseSnapshot(DBStr=None):
+    with _registry_lock:
+        _snapshots.pop(DBStr, None)
+
+
+@event.listens_for(Session, 'after_commit')
+def _RefreshSnapshotsOnCommit(s):
+    # tracked apart from dblib_written so it doesn't matter which after_commit listener runs first
+    written = s.info.pop('dblib_snapshot_written', None)
+    if not written or not _snapshots:
+        return
+    DBStr = _engine_dbstrs.get(s.get_bind())
+    if DBStr in _snapshots:
+        for thisTable in _SNAPSHOT_INDEXES:
+            if thisTable.__tablename__ in written:
+                _LoadIntoSnapshot(DBStr, _snapshots[DBStr], thisTable, written[thisTable.__tablename__])
 
-        session = sessionmaker()
-        session.configure(bind=engine)
-        Base.metadata.create_all(engine)
-        s = session()
+
+################################ Functions ################################
+
+# keep IN (...) lists and multi-row statements well under SQLite's bound-parameter limit
+_MAX_SQL_PARAMS = 500
+
+
+def _FileStarts(s, filenames):
+    # file_start for each basename, looked up once per file instead of once per event
+    file_starts = {}
+    filenames = list(filenames)
+    for i in range(0, len(filenames), _MAX_SQL_PARAMS):
+        these_names = filenames[i:i + _MAX_SQL_PARAMS]
+        for fname, fstart in s.query(DataFiles.file_name, DataFiles.file_start).filter(DataFiles.file_name.in_(these_names)):
+            file_starts.setdefault(fname, fstart)
+    return file_starts
+
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _EpochSeconds(thisTime):
+    # absolute times are plain float seconds so they index and compare cheaply
+    if thisTime is None:
+        return None
+    if isinstance(thisTime, datetime.datetime):
+        delta = thisTime - _EPOCH
+        return delta.days * 86400.0 + delta.seconds + delta.microseconds / 1e6
+    return float(thisTime)
+
+
+def _AbsTimes(file_start, event_start, event_end):
+    offset = _EpochSeconds(file_start)
+    if offset is None:
+        return None, None
+    return (offset + event_start if event_start is not None else None,
+            offset + event_end if event_end is not None else None)
+
+
+def _EventRow(thisEvent, file_start=None, paramVersion=None):
+    # column mapping for one detected event, matching what AddToDb(thisEvent=...) stores
+    abs_start, abs_end = _AbsTimes(file_start, thisEvent.Start, thisEvent.End)
+    if paramVersion is None:
+        paramVersion = getattr(thisEvent, 'ParamVersion', None)
+    return {'abs_start': abs_start,
+            'abs_end': abs_end,
+            'animal': thisEvent.Animal,
+            'filename': path.basename(thisEvent.FileName),
+            'filepath': path.dirname(path.abspath(thisEvent.FileName)),
+            'event_start': thisEvent.Start,
+            'event_end': thisEvent.End,
+            'racine_score': thisEvent.RacineScore,
+            'file_start': file_start,
+            'meta_text': thisEvent.Description,
+            'event_type': thisEvent.Event,
+            'how_found': thisEvent.HowFound,
+            'param_version': paramVersion}
+
+
+def _DetectionRunRows(event_rows, detectedFiles=None, paramVersion=None):
+    # DetectionRuns rows for the files of event_rows that carry a param_version, plus the (animal,
+    # filename) pairs of detectedFiles, which were run with paramVersion
+    if detectedFiles and paramVersion is None:
+        raise ValueError('detectedFiles needs the paramVersion they were run with')
+    runs = set((row['animal'], row['filename'], row['param_version']) for row in event_rows
+               if row['param_version'] is not None)
+    runs.update((animal, path.basename(filename), paramVersion) for animal, filename in detectedFiles or [])
+    return [{'animal': animal, 'filename': filename, 'param_version': version}
+            for animal, filename, version in runs]
+
+
+def _DataFileRow(thisDataFile):
+    # column mapping for one (filename, chandata) channel, matching what AddToDb(thisDataFile=...) stores
+    longfilename = thisDataFile[0]
+    chandata = thisDataFile[1]
+    try:
+        # if we don't have a valid file start then leave it empty
+        file_start = datetime.datetime(*chandata.file_start[:6])
+    except:
+        file_start = None
+    return {'animal': chandata.name,
+            'file_name': path.basename(str(longfilename)),
+            'file_path': path.dirname(path.abspath(longfilename)),
+            'file_start': file_start,
+            'chan_idx': chandata.idx,
+            'file_length': chandata.file_length,
+            'chan_number': chandata.number,
+            'sample_freq': chandata.sample_freq}
+
+
+_TABLES = {'DataFiles': DataFiles,
+           'unusedDataFiles': unusedDataFiles,
+           'AnimalChannelList': AnimalChannelList,
+           'AlgorithmParameters': AlgorithmParameters,
+           'Events': Events,
+           'DetectionRuns': DetectionRuns}
+
+_CONFLICT_MODES = (None, 'ignore', 'replace')
+
+
+def _KeyNames(thisTable):
+    return [col.name for col in thisTable.__table__.primary_key.columns]
+
+
+def _NormaliseKey(thisTable, key):
+    # file names are stored as basenames, same as AddToDb does
+    return tuple(path.basename(str(value)) if name in ('filename', 'file_name') else value
+                 for name, value in zip(_KeyNames(thisTable), key))
+
+
+def _KeyMatch(key_cols, keys):
+    # keys sharing everything but the last key column become one 'prefix = ... AND last IN (...)'
+    # term, and the terms are ORed. SQLite answers that with primary-key probes, whereas a row-value
+    # (a, b, c) IN (VALUES ...) makes it scan the whole table
+    by_prefix = collections.OrderedDict()
+    for key in keys:
+        by_prefix.setdefault(tuple(key[:-1]), []).append(key[-1])
+    return or_(*[and_(*([col == value for col, value in zip(key_cols[:-1], prefix)] + [key_cols[-1].in_(last_values)]))
+                 for prefix, last_values in by_prefix.items()])
+
+
+def _ExistingKeys(s, thisTable, keys):
+    # one SELECT per chunk of candidate primary keys; returns the ones already stored
+    key_cols = list(thisTable.__table__.primary_key.columns)
+    chunk_size = max(1, _MAX_SQL_PARAMS // len(key_cols))
+    keys = list(keys)
+    found = set()
+    for i in range(0, len(keys), chunk_size):
+        for row in s.query(*key_cols).filter(_KeyMatch(key_cols, keys[i:i + chunk_size])):
+            found.add(tuple(row))
+    return found
+
+
+def _InsertRows(s, thisTable, rows, onConflict=None):
+    # executemany insert of column dicts. onConflict='ignore' keeps rows that are already stored,
+    # 'replace' overwrites them; both cost a constant number of statements per call
+    if onConflict not in _CONFLICT_MODES:
+        raise ValueError('onConflict must be one of %s' % (_CONFLICT_MODES,))
+    table = thisTable.__table__
+    if onConflict is None:
+        s.execute(table.insert(), rows)
+        return
+    if s.get_bind().dialect.name == 'sqlite':
+        s.execute(table.insert().prefix_with('OR ' + onConflict.upper()), rows)
+        return
+
+    # no INSERT OR ... outside sqlite, so resolve clashes with a key lookup per chunk instead
+    key_names = _KeyNames(thisTable)
+    by_key = {}
+    for row in rows:
+        key = tuple(row[name] for name in key_names)
+        if onConflict == 'replace' or key not in by_key:
+            by_key[key] = row
+    existing = _ExistingKeys(s, thisTable, by_key.keys())
+    if onConflict == 'ignore':
+        rows = [row for key, row in by_key.items() if key not in existing]
     else:
-        s = thisSession
+        rows = list(by_key.values())
+        key_cols = list(table.primary_key.columns)
+        existing = list(existing)
+        chunk_size = max(1, _MAX_SQL_PARAMS // len(key_cols))
+        for i in range(0, len(existing), chunk_size):
+            s.execute(table.delete().where(_KeyMatch(key_cols, existing[i:i + chunk_size])))
+    if rows:
+        s.execute(table.insert(), rows)
+
+
+def _AddObject(s, thisdatafile, onConflict=None):
+    if onConflict not in _CONFLICT_MODES:
+        raise ValueError('onConflict must be one of %s' % (_CONFLICT_MODES,))
+    if onConflict == 'replace':
+        s.merge(thisdatafile)
+        return
+    if onConflict == 'ignore' and not isinstance(thisdatafile, AnimalChannelList):
+        pk = object_mapper(thisdatafile).primary_key_from_instance(thisdatafile)
+        if s.query(type(thisdatafile)).get(pk) is not None:
+            return
+    s.add(thisdatafile)
+
+
+@_Profiled
+def CreateDB(DBStr=None):
+    engine = GetEngine(DBStr)
+    Base.metadata.create_all(engine)
+
+def _IndexNames(engine, inspector, tableName):
+    # the inspector skips SQLite's expression indexes (with a warning), so there they come from sqlite_master
+    if engine.dialect.name != 'sqlite':
+        return set(ix['name'] for ix in inspector.get_indexes(tableName))
+    with engine.connect() as conn:
+        return set(name for (name,) in conn.execute(
+            text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table"), table=tableName))
+
+@_Profiled
+def MigrateIndexes(DBStr=None):
+    # create_all only builds indexes together with new tables, so databases made before the
+    # indexes were declared get them added here, in place. Returns the names of the new indexes
+    engine = GetEngine(DBStr)
+    inspector = inspect(engine)
+    created = []
+    for table in Base.metadata.sorted_tables:
+        existing = _IndexNames(engine, inspector, table.name)
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+                created.append(index.name)
+    if created and engine.dialect.name == 'sqlite':
+        # refresh planner statistics so the new indexes actually get picked
+        with engine.begin() as conn:
+            conn.execute(text('ANALYZE'))
+    return created
+
+_PlanEvent = collections.namedtuple('_PlanEvent', 'Animal FileName Start')
+
+def _PlannedCalls(DBStr):
+    # the DBlib read calls CheckQueryPlans runs, with placeholder arguments. It explains the SQL these
+    # calls actually send, so the check follows the functions whenever their queries change
+    def find_channel():
+        try:
+            FindInDb(DBStr, 'AnimalChannelList', thisAnimal='x')
+        except NoResultFound:
+            pass
+
+    def file_starts():
+        with DbSession(DBStr, readOnly=True) as s:
+            return _FileStarts(s, ['x', 'y'])
+
+    day = datetime.date(2000, 1, 1)
+    return [('GetAllSeizures', lambda: GetAllSeizures(DBStr, 'x')),
+            ('IterAllSeizures', lambda: list(IterAllSeizures(DBStr, 'x'))),
+            ('GetAllFiles', lambda: GetAllFiles(DBStr, 'x')),
+            ('GetAllChans', lambda: GetAllChans(DBStr, 'x')),
+            ('FindInDb Events', lambda: FindInDb(DBStr, 'Events', 'x', thisAnimal='x')),
+            ('FindInDb DataFiles', lambda: FindInDb(DBStr, 'DataFiles', 'x', thisAnimal='x')),
+            ('FindInDb unusedDataFiles', lambda: FindInDb(DBStr, 'unusedDataFiles', thisAnimal='x')),
+            ('FindInDb AnimalChannelList channel', find_channel),
+            ('FindInDb AnimalChannelList compound_animal',
+             lambda: FindInDb(DBStr, 'AnimalChannelList', thisCompoundAnimal='x')),
+            ('EntryExists Events', lambda: EntryExists(DBStr, thisEvent=_PlanEvent('x', 'x', 0.0))),
+            ('EntryExists DataFiles', lambda: EntryExists(DBStr, thisFileName='x', unusedDataFlag=False)),
+            ('EntryExists unusedDataFiles', lambda: EntryExists(DBStr, thisFileName='x')),
+            ('EntriesExist Events', lambda: EntriesExist(DBStr, 'Events', [('x', 'x', 0.0), ('x', 'x', 1.0)])),
+            ('EntriesExist DataFiles', lambda: EntriesExist(DBStr, 'DataFiles', [('x', 'x'), ('x', 'y')])),
+            ('AddEvents file_start', file_starts),
+            ('FindEventsOverlapping', lambda: FindEventsOverlapping(DBStr, 'x', 0.0, 1.0)),
+            ('FindEventsOverlapping file-relative', lambda: FindEventsOverlapping(DBStr, 'x', 0.0, 1.0, 'x')),
+            ('FindEventsWithin', lambda: FindEventsWithin(DBStr, 'x', 0.0, 1.0)),
+            ('FindNearestEvent', lambda: FindNearestEvent(DBStr, 'x', 0.0)),
+            ('FilesToDetect', lambda: FilesToDetect(DBStr, 'x', ['x'], 'x')),
+            ('DailySeizureBurden', lambda: DailySeizureBurden(DBStr, 'x', day, day))]
+
+@contextmanager
+def _IssuedStatements():
+    # (statement, parameters) for each statement this thread sends while the block runs. Snapshots
+    # are bypassed meanwhile, so the calls go to the database rather than being answered from memory
+    statements = []
+    thread = threading.current_thread()
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and threading.current_thread() is thread:
+            statements.append((statement, parameters))
+    event.listen(Engine, 'before_cursor_execute', capture)
+    _snapshot_local.bypass = True
+    try:
+        yield statements
+    finally:
+        _snapshot_local.bypass = False
+        event.remove(Engine, 'before_cursor_execute', capture)
+
+@_Profiled
+def CheckQueryPlans(DBStr=None):
+    # runs EXPLAIN QUERY PLAN (sqlite only) on every SELECT the DBlib read functions issue and reports
+    # whether an index serves it. Returns {query name: (uses_index, plan text)}; a call that issues
+    # several SELECTs gets one entry per statement, named 'name #1', 'name #2', ...
+    engine = GetEngine(DBStr)
+    if engine.dialect.name != 'sqlite':
+        raise ValueError('CheckQueryPlans needs an sqlite database, not %s' % engine.dialect.name)
+    plans = {}
+    for name, call in _PlannedCalls(DBStr):
+        with _IssuedStatements() as statements:
+            call()
+        selects = [(statement, parameters) for statement, parameters in statements
+                   if statement.lstrip().upper().startswith('SELECT')]
+        conn = engine.raw_connection()
+        try:
+            for i, (statement, parameters) in enumerate(selects):
+                cursor = conn.cursor()
+                cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+                plan = ' | '.join(str(row[-1]) for row in cursor.fetchall())
+                cursor.close()
+                # 'SCAN t' without an index is a full table walk; SEARCH ... USING (PRIMARY KEY|INDEX) is not
+                uses_index = 'SEARCH' in plan and not any(step.strip().startswith('SCAN') and 'INDEX' not in step
+                                                          for step in plan.split('|'))
+                plans[name if len(selects) == 1 else '%s #%d' % (name, i + 1)] = (uses_index, plan)
+        finally:
+            conn.close()
+    return plans
+
+@_Profiled
+def EntryExists(DBStr=None, thisSession=None, thisDataFile=None, thisFileName=None, unusedDataFlag=True, AlgPars = None, thisEvent=None):
 
     if thisDataFile != None:
         longfilename = thisDataFile[0]
@@ -162,90 +1170,86 @@ def EntryExists(DBStr=None, thisSession=None, thisDataFile=None, thisFileName=No
         thispath=path.dirname(path.abspath(longfilename))
         fname=path.basename(str(longfilename))
 
-    if  thisFileName != None and unusedDataFlag == True:
-        fname = path.basename(str(thisFileName))
-        entry_query = s.query(unusedDataFiles).filter(unusedDataFiles.file_name==fname).all()
-    elif  thisFileName != None and unusedDataFlag == False:
-        fname = path.basename(str(thisFileName))
-        entry_query = s.query(DataFiles).filter(DataFiles.file_name==fname).all()
-    elif thisDataFile != None and unusedDataFlag == False:
-        entry_query = s.query(DataFiles).filter(DataFiles.file_name==fname, DataFiles.animal==thischandata.name).all()
-    elif  thisDataFile != None and unusedDataFlag == True:
-        entry_query = s.query(unusedDataFiles).filter(unusedDataFiles.file_name==fname, unusedDataFiles.animal==thischandata.name).all()
-    elif thisDataFile != None and unusedDataFlag == False:
-        entry_query = s.query(DataFiles).filter(DataFiles.file_name==fname, DataFiles.animal==thischandata.name).all()
-    elif AlgPars != None:
-        entry_query = s.query(AlgorithmParameters).filter(AlgorithmParameters.animal==AlgPars[0])
-
-    elif thisEvent != None:
-        entry_query = s.query(Events).filter(Events.event_start==thisEvent.Start,
-                                                       Events.animal==thisEvent.Animal,
-                                                       Events.filename==path.basename(thisEvent.FileName))
-    if not thisSession:
-        s.close()
-        engine.dispose()
+    if thisSession is None:
+        found = _ExistsInSnapshot(DBStr, thisDataFile, thisFileName, unusedDataFlag, AlgPars, thisEvent)
+        if found is not None:
+            return found
+    with DbSession(DBStr, thisSession, readOnly=True) as s:
+        if  thisFileName != None and unusedDataFlag == True:
+            fname = path.basename(str(thisFileName))
+            entry_query = s.query(unusedDataFiles).filter(unusedDataFiles.file_name==fname).all()
+        elif  thisFileName != None and unusedDataFlag == False:
+            fname = path.basename(str(thisFileName))
+            entry_query = s.query(DataFiles).filter(DataFiles.file_name==fname).all()
+        elif thisDataFile != None and unusedDataFlag == False:
+            entry_query = s.query(DataFiles).filter(DataFiles.file_name==fname, DataFiles.animal==thischandata.name).all()
+        elif  thisDataFile != None and unusedDataFlag == True:
+            entry_query = s.query(unusedDataFiles).filter(unusedDataFiles.file_name==fname, unusedDataFiles.animal==thischandata.name).all()
+        elif AlgPars != None:
+            entry_query = s.query(AlgorithmParameters).filter(AlgorithmParameters.animal==AlgPars[0]).all()
+
+        elif thisEvent != None:
+            entry_query = s.query(Events).filter(Events.event_start==thisEvent.Start,
+                                                           Events.animal==thisEvent.Animal,
+                                                           Events.filename==path.basename(thisEvent.FileName)).all()
 
     if entry_query == None or entry_query==[]:
         return False
     else:
         return True
 
+@_Profiled
+def EntriesExist(DBStr=None, thisTable='Events', keys=None, thisSession=None):
+    # set-based EntryExists. keys are primary-key tuples - (animal, filename, event_start) for Events,
+    # (animal, file_name) for DataFiles/unusedDataFiles - checked with one query per chunk of keys.
+    # Returns a list of booleans in the same order as keys
+    thisTable = _TABLES[thisTable]
+    keys = [_NormaliseKey(thisTable, key) for key in (keys or [])]
+    with DbSession(DBStr, thisSession, readOnly=True) as s:
+        found = _ExistingKeys(s, thisTable, set(keys))
+    return [key in found for key in keys]
+
+@_Profiled
 def MakeAnimalChanDict(DBStr=None):
-    engine = create_engine(DBStr)
-
-    session = sessionmaker()
-    session.configure(bind=engine)
-    Base.metadata.create_all(engine)
-    s = session()
-
-    entry_query = s.query(AnimalChannelList).all()
-    # first remove all the null entries
-    for thisentry in reversed(entry_query):
-        if thisentry.channel == None:
-            entry_query.remove(thisentry)
-
-    # now make dictionary
-    AnimalChannelDict = {}
-    for thisentry in entry_query:
-        AnimalChannelDict[str(thisentry.channel)] = str(thisentry.compound_animal)
-    s.close()
-    engine.dispose()
-    return AnimalChannelDict
-
-
-def FindInDb(DBStr=None, thisTable=None, thisFilename = None, unusedDataFlag = True, thisAnimal=None, thisCompoundAnimal=None):
-    engine = create_engine(DBStr)
-
-    session = sessionmaker()
-    session.configure(bind=engine)
-    Base.metadata.create_all(engine)
-    s = session()
-
-    if thisTable == 'Events':
-        entry_query = s.query(Events).filter(Events.filename==path.basename(thisFilename), Events.animal==thisAnimal).all()
-    if thisTable == 'unusedDataFiles':
-        entry_query = s.query(unusedDataFiles).filter(unusedDataFiles.animal==thisAnimal).all()
-    if thisTable == 'DataFiles' and thisAnimal==None:
-        entry_query = s.query(DataFiles).filter(DataFiles.animal==thisAnimal).all()
-    elif thisTable == 'DataFiles' and thisAnimal!=None:
-        entry_query = s.query(DataFiles).filter(DataFiles.animal==thisAnimal, DataFiles.file_name==path.basename(thisFilename)).all()
-    if thisTable == 'AnimalChannelList' and thisAnimal != None:
-        entry_query = s.query(AnimalChannelList).filter(AnimalChannelList.channel==thisAnimal).one()
-    if thisTable == 'AnimalChannelList' and thisCompoundAnimal != None:
-        entry_query = s.query(AnimalChannelList).filter(AnimalChannelList.compound_animal==thisCompoundAnimal).all()
-    s.close()
-    engine.dispose()
+    def load():
+        with DbSession(DBStr, readOnly=True) as s:
+            # null channels are dropped in SQL; ordering by id keeps the last entry for a channel winning
+            entry_query = s.query(AnimalChannelList.channel, AnimalChannelList.compound_animal).filter(
+                AnimalChannelList.channel != None).order_by(AnimalChannelList.id)
+            AnimalChannelDict = {}
+            for channel, compound_animal in entry_query:
+                AnimalChannelDict[str(channel)] = str(compound_animal)
+        return AnimalChannelDict
+    return dict(_CachedLookup(DBStr, 'AnimalChannelList', 'channel_dict', load))
+
+
+@_Profiled
+def FindInDb(DBStr=None, thisTable=None, thisFilename = None, unusedDataFlag = True, thisAnimal=None, thisCompoundAnimal=None,
+             thisSession=None):
+    if thisSession is None:
+        entry_query = _FindInSnapshot(DBStr, thisTable, thisFilename, thisAnimal, thisCompoundAnimal)
+        if entry_query is not None:
+            return entry_query
+    with DbSession(DBStr, thisSession, readOnly=True) as s:
+        if thisTable == 'Events':
+            entry_query = s.query(Events).filter(Events.filename==path.basename(thisFilename), Events.animal==thisAnimal).all()
+        if thisTable == 'unusedDataFiles':
+            entry_query = s.query(unusedDataFiles).filter(unusedDataFiles.animal==thisAnimal).all()
+        if thisTable == 'DataFiles' and thisAnimal==None:
+            entry_query = s.query(DataFiles).filter(DataFiles.animal==thisAnimal).all()
+        elif thisTable == 'DataFiles' and thisAnimal!=None:
+            entry_query = s.query(DataFiles).filter(DataFiles.animal==thisAnimal, DataFiles.file_name==path.basename(thisFilename)).all()
+        if thisTable == 'AnimalChannelList' and thisAnimal != None:
+            entry_query = s.query(AnimalChannelList).filter(AnimalChannelList.channel==thisAnimal).one()
+        if thisTable == 'AnimalChannelList' and thisCompoundAnimal != None:
+            entry_query = s.query(AnimalChannelList).filter(AnimalChannelList.compound_animal==thisCompoundAnimal).all()
     return entry_query
-    s.commit()
 
+@_Profiled
 def MoveAnimals(DBStr=None, oldTable=None, newTable=None, thisFilename = None, unusedDataFlag = True, thisAnimal=None):
-    engine = create_engine(DBStr)
-
-    session = sessionmaker()
-    session.configure(bind=engine)
-    Base.metadata.create_all(engine)
-    s = session()
-
+    # moves every row for thisAnimal (one name or a list of names) between DataFiles and unusedDataFiles
+    # server-side, as INSERT ... SELECT + DELETE in one transaction, carrying every column the target
+    # table has. Returns the number of rows moved
     if oldTable == 'unusedDataFiles':
         oldTable = unusedDataFiles
         newTable = DataFiles
@@ -253,134 +1257,282 @@ def MoveAnimals(DBStr=None, oldTable=None, newTable=None, thisFilename = None, u
         oldTable = DataFiles
         newTable = unusedDataFiles
 
-    entry_query = s.query(oldTable).filter(oldTable.animal==thisAnimal).all()
-
-    for olddatafile in entry_query:
-               # if unusedDataFlag:
-        thisdatafile = newTable(file_name=olddatafile.file_name)
-       # else:
-        #    thisdatafile = DataFiles(file_name=fname)
-        thisdatafile.animal = olddatafile.animal
-        thisdatafile.file_path = olddatafile.file_path
-        thisdatafile.chan_idx=olddatafile.chan_idx
-        thisdatafile.file_length=olddatafile.file_length
-        thisdatafile.chan_number=olddatafile.chan_number
-        thisdatafile.sample_freq=olddatafile.sample_freq
-        try:
-            # if we don't have a valid file start then skip this step
-            thisdatafile.file_start = olddatafile.file_start
-        except:
-            pass
-        s.add(thisdatafile)
-
-    # now delete from old table
-    entry_query = s.query(oldTable).filter(oldTable.animal==thisAnimal)
-
-    if entry_query == None or entry_query==[]:
-        s.close()
-        engine.dispose()
-        return False
-    elif type(entry_query) is list:
-        for this_query in entry_query:
-            this_query.delete()
+    if isinstance(thisAnimal, (list, tuple, set)):
+        animals = list(thisAnimal)
     else:
-        entry_query.delete()
-    s.commit()
-    s.close()
-    engine.dispose()
-    return
-
-def UpdateDb(DBStr=None, thisDataFile = None, unusedDataFlag = True, thisAnimal=None, thisVideoPath=None, fileReviewed=None):
-    engine = create_engine(DBStr)
-
-    session = sessionmaker()
-    session.configure(bind=engine)
-    Base.metadata.create_all(engine)
-    s = session()
-    if thisVideoPath != None:
-        s.query(DataFiles).filter(DataFiles.animal==thisAnimal).update({'video_file_path': thisVideoPath})
-    if fileReviewed != None:
-        s.query(DataFiles).filter(DataFiles.animal==thisAnimal, DataFiles.file_name==thisDataFile).update({'reviewed': fileReviewed})
-    s.commit()
-    s.close()
-    engine.dispose()
+        animals = [thisAnimal]
+
+    old = oldTable.__table__
+    new = newTable.__table__
+    shared_cols = [col.name for col in new.columns if col.name in old.c]
+    moved = 0
+    with DbSession(DBStr) as s:
+        for i in range(0, len(animals), _MAX_SQL_PARAMS):
+            these_animals = animals[i:i + _MAX_SQL_PARAMS]
+            rows = select([old.c[name] for name in shared_cols]).where(old.c.animal.in_(these_animals))
+            s.execute(new.insert().from_select(shared_cols, rows))
+            moved += s.execute(old.delete().where(old.c.animal.in_(these_animals))).rowcount
+        _MarkWritten(s, oldTable, newTable, animals=animals)
+    return moved
+
+@_Profiled
+def UpdateDb(DBStr=None, thisDataFile = None, unusedDataFlag = True, thisAnimal=None, thisVideoPath=None, fileReviewed=None,
+             thisSession=None):
+    with DbSession(DBStr, thisSession) as s:
+        if thisVideoPath != None:
+            s.query(DataFiles).filter(DataFiles.animal==thisAnimal).update({'video_file_path': thisVideoPath})
+        if fileReviewed != None:
+            s.query(DataFiles).filter(DataFiles.animal==thisAnimal, DataFiles.file_name==thisDataFile).update({'reviewed': fileReviewed})
+        _MarkWritten(s, DataFiles, animals=[thisAnimal])
     return
    # stmt = DataFiles.update().where(DataFiles.Animal==thisAnimal).values(name='user #5')
 
-def AddToDb(DBStr=None, thisSession=None, thisDataFile = None, unusedDataFlag = True, AlgPars=None,
-            thisEvent=None, thisCompoundAnimal=None, thisChannel=None):
-    if not thisSession:
-        engine = create_engine(DBStr)
-
-        session = sessionmaker()
-        session.configure(bind=engine)
-        Base.metadata.create_all(engine)
-        s = session()
-    else:
-        s = thisSession
-
-    if thisDataFile != None:
-        longfilename = thisDataFile[0]
-        chandata = thisDataFile[1]
-        thispath=path.dirname(path.abspath(longfilename))
-        fname=path.basename(str(longfilename))
-
-        if unusedDataFlag:
-            thisdatafile = unusedDataFiles(file_name=fname)
-        else:
-            thisdatafile = DataFiles(file_name=fname)
-        thisdatafile.animal = chandata.name
-        thisdatafile.file_path = thispath
-        thisdatafile.chan_idx=chandata.idx
-        thisdatafile.file_length=chandata.file_length
-        thisdatafile.chan_number=chandata.number
-        thisdatafile.sample_freq=chandata.sample_freq
-        try:
-            # if we don't have a valid file start then skip this step
-            thisdatafile.file_start = datetime.datetime(*chandata.file_start[:6])
-        except:
-            pass
-
-    if thisEvent != None:
-        thisdatafile=Events(animal=thisEvent.Animal,
-                                      filename=path.basename(thisEvent.FileName),
-                                      event_start=thisEvent.Start)
-        entry_query = s.query(DataFiles).filter(DataFiles.file_name==path.basename(thisEvent.FileName)).first()
-        thisdatafile.file_start = entry_query.file_start
-
-        thisdatafile.event_end=thisEvent.End
-        thisdatafile.meta_text=thisEvent.Description
-        thisdatafile.racine_score=thisEvent.RacineScore
-        thisdatafile.filepath = path.dirname(path.abspath(thisEvent.FileName))
-        thisdatafile.event_type=thisEvent.Event
-        thisdatafile.how_found = thisEvent.HowFound
-
-    if thisCompoundAnimal!=None:
-        if thisChannel == None:
-            thisdatafile = AnimalChannelList(compound_animal=thisCompoundAnimal)
+@_Profiled
+def UpdateDataFiles(DBStr=None, updates=None, thisTable='DataFiles', thisSession=None):
+    # bulk version of UpdateDb for any non-key column: updates maps a key to the new column values,
+    # where the key is (animal, file_name) for one file or a bare animal for all of that animal's files, e.g.
+    #     {('rat1_ch1', 'f1.smr'): {'reviewed': True}, 'rat2_ch1': {'video_file_path': '/video/rat2'}}
+    # Keys that change the same columns share one executemany UPDATE, all in a single transaction.
+    # Returns the number of rows updated
+    thisTable = _TABLES[thisTable]
+    table = thisTable.__table__
+    key_names = _KeyNames(thisTable)
+    batches = collections.defaultdict(list)
+    for key, values in (updates or {}).items():
+        unknown = [name for name in values if name not in table.c or name in key_names]
+        if unknown:
+            raise ValueError('%s has no updatable column(s) %s' % (thisTable.__tablename__, ', '.join(unknown)))
+        if not values:
+            continue
+        if isinstance(key, tuple):
+            key = _NormaliseKey(thisTable, key)
+            params = {'b_animal': key[0], 'b_file_name': key[1]}
         else:
-            thisdatafile = AnimalChannelList(compound_animal=thisCompoundAnimal, channel=thisChannel)
-
-
-    if AlgPars != None:# and not unusedDataFlag:
-        thisdatafile=AlgorithmParameters(animal = AlgPars[0])
-
-    s.add(thisdatafile)
-    if not thisSession:
-        s.commit()
-    if not thisSession:
-        s.close()
-        engine.dispose()
+            params = {'b_animal': key}
+        params.update(('v_' + name, value) for name, value in values.items())
+        batches[(len(params) - len(values), tuple(sorted(values)))].append(params)
+
+    n_rows = 0
+    with DbSession(DBStr, thisSession) as s:
+        for (n_keys, columns), params in batches.items():
+            where = table.c.animal == bindparam('b_animal')
+            if n_keys == 2:
+                where = where & (table.c.file_name == bindparam('b_file_name'))
+            stmt = table.update().where(where).values(dict((name, bindparam('v_' + name)) for name in columns))
+            n_rows += s.execute(stmt, params).rowcount
+        _MarkWritten(s, thisTable, animals=set(p['b_animal'] for params in batches.values() for p in params))
+    return n_rows
+
+@_Profiled
+def AddToDb(DBStr=None, thisSession=None, thisDataFile = None, unusedDataFlag = True, AlgPars=None,
+            thisEvent=None, thisCompoundAnimal=None, thisChannel=None, onConflict=None):
+    # onConflict: None raises on a duplicate key as before, 'ignore' leaves the stored row alone,
+    # 'replace' overwrites it
+    with DbSession(DBStr, thisSession) as s:
+        if thisDataFile != None:
+            longfilename = thisDataFile[0]
+            chandata = thisDataFile[1]
+            thispath=path.dirname(path.abspath(longfilename))
+            fname=path.basename(str(longfilename))
+
+            if unusedDataFlag:
+                thisdatafile = unusedDataFiles(file_name=fname)
+            else:
+                thisdatafile = DataFiles(file_name=fname)
+            thisdatafile.animal = chandata.name
+            thisdatafile.file_path = thispath
+            thisdatafile.chan_idx=chandata.idx
+            thisdatafile.file_length=chandata.file_length
+            thisdatafile.chan_number=chandata.number
+            thisdatafile.sample_freq=chandata.sample_freq
+            try:
+                # if we don't have a valid file start then skip this step
+                thisdatafile.file_start = datetime.datetime(*chandata.file_start[:6])
+            except:
+                pass
+
+        if thisEvent != None:
+            thisdatafile=Events(animal=thisEvent.Animal,
+                                          filename=path.basename(thisEvent.FileName),
+                                          event_start=thisEvent.Start)
+            entry_query = s.query(DataFiles).filter(DataFiles.file_name==path.basename(thisEvent.FileName)).first()
+            thisdatafile.file_start = entry_query.file_start
+
+            thisdatafile.event_end=thisEvent.End
+            thisdatafile.meta_text=thisEvent.Description
+            thisdatafile.racine_score=thisEvent.RacineScore
+            thisdatafile.filepath = path.dirname(path.abspath(thisEvent.FileName))
+            thisdatafile.event_type=thisEvent.Event
+            thisdatafile.how_found = thisEvent.HowFound
+            thisdatafile.param_version = getattr(thisEvent, 'ParamVersion', None)
+            thisdatafile.abs_start, thisdatafile.abs_end = _AbsTimes(thisdatafile.file_start,
+                                                                     thisEvent.Start, thisEvent.End)
+
+        if thisCompoundAnimal!=None:
+            if thisChannel == None:
+                thisdatafile = AnimalChannelList(compound_animal=thisCompoundAnimal)
+            else:
+                thisdatafile = AnimalChannelList(compound_animal=thisCompoundAnimal, channel=thisChannel)
+
+
+        if AlgPars != None:# and not unusedDataFlag:
+            thisdatafile=AlgorithmParameters(animal = AlgPars[0])
+
+        _AddObject(s, thisdatafile, onConflict)
+        _MarkWritten(s, type(thisdatafile), animals=[getattr(thisdatafile, 'animal', None)])
+        if thisEvent != None:
+            _RefreshDailySummary(s, [(thisdatafile.animal, thisdatafile.abs_start)])
+            run_rows = _DetectionRunRows([_EventRow(thisEvent)])
+            if run_rows:
+                _InsertRows(s, DetectionRuns, run_rows, 'ignore')
+                _MarkWritten(s, DetectionRuns)
     return
 
-def RemoveFromDb(DBStr=None, thisTable=None, thisFileName=None, thisAnimalName=None, thisDataFile=None, unusedDataFlag=True, AlgPars = None, thisEvent=None):
-
-    engine = create_engine(DBStr)
-
-    session = sessionmaker()
-    session.configure(bind=engine)
-    Base.metadata.create_all(engine)
-    s = session()
+@_Profiled
+def AddEvents(DBStr=None, events=None, chunk_size=5000, thisSession=None, onConflict=None, paramVersion=None,
+              detectedFiles=None):
+    # bulk version of AddToDb(thisEvent=...): file_start is resolved once per file and the
+    # events go in as executemany Core inserts, chunk by chunk, inside a single transaction.
+    # onConflict='ignore' makes re-running detection on a file skip the events already stored;
+    # each chunk's throughput is logged at INFO. paramVersion (see ParameterVersion) is stored on every
+    # event, otherwise each event's own ParamVersion attribute is used if it has one. The files of
+    # versioned events are recorded in DetectionRuns, and so are the (animal, filename) pairs of
+    # detectedFiles, the files run with paramVersion that found nothing (listing all of them is fine)
+    events = list(events or [])
+    run_rows = _DetectionRunRows([], detectedFiles, paramVersion)
+    if not events and not run_rows:
+        return 0
+
+    with DbSession(DBStr, thisSession) as s:
+        file_starts = _FileStarts(s, set(path.basename(e.FileName) for e in events))
+        for i in range(0, len(events), chunk_size):
+            chunk_start = time.time()
+            rows = [_EventRow(e, file_starts.get(path.basename(e.FileName)), paramVersion)
+                    for e in events[i:i + chunk_size]]
+            run_rows += _DetectionRunRows(rows)
+            _InsertRows(s, Events, rows, onConflict)
+            _MarkWritten(s, Events, animals=set(row['animal'] for row in rows))
+            _RefreshDailySummary(s, [(row['animal'], row['abs_start']) for row in rows])
+            elapsed = time.time() - chunk_start
+            log.info('AddEvents chunk %d: %d rows in %.3f s (%.0f rows/s)', i // chunk_size, len(rows), elapsed,
+                     len(rows) / max(elapsed, 1e-9))
+        if run_rows:
+            _InsertRows(s, DetectionRuns, run_rows, 'ignore')
+            _MarkWritten(s, DetectionRuns)
+    return len(events)
+
+def _ReadHeader(headerReader, longfilename):
+    try:
+        return longfilename, list(headerReader(longfilename)), None
+    except Exception as e:
+        return longfilename, None, repr(e)
+
+@_Profiled
+def RegisterDirectory(DBStr=None, rootDir=None, headerReader=None, unusedDataFlag=True, extensions=('.smr',),
+                      nThreads=8, thisSession=None):
+    # bulk version of AddToDb(thisDataFile=...) for a whole recording session: every file under rootDir
+    # whose extension matches (extensions=None takes all) is a candidate. headerReader(filename) returns
+    # the file's channels as chandata objects (name, idx, number, sample_freq, file_length, file_start).
+    # Registrations in either DataFiles or unusedDataFiles count, and a channel already in one of them
+    # (e.g. moved there by MoveAnimals) stays there; new channels go to the table unusedDataFlag picks.
+    # Files already registered with the same path, size and mtime are skipped; the rest have their
+    # headers read on nThreads threads, and their old rows are replaced by the new ones in a single
+    # transaction. A file whose header cannot be read is reported in 'failed' and left untouched.
+    # Rows are keyed by file name alone, so a name found in two directories (under rootDir, or under
+    # rootDir and an earlier registration whose file is still there) is reported in 'failed' too;
+    # if the earlier file is gone the new one counts as the same file moved. The header-reading time
+    # is logged at INFO
+    thisTable = unusedDataFiles if unusedDataFlag else DataFiles
+    if extensions is not None:
+        extensions = tuple(ext.lower() for ext in extensions)
+
+    candidates = {}
+    for dirpath, dirnames, filenames in os.walk(rootDir):
+        for fname in filenames:
+            if extensions is not None and not fname.lower().endswith(extensions):
+                continue
+            longfilename = path.join(dirpath, fname)
+            try:
+                st = os.stat(longfilename)
+            except OSError:
+                continue
+            candidates[(path.dirname(path.abspath(longfilename)), fname)] = (longfilename, st.st_size, st.st_mtime)
+
+    with DbSession(DBStr, thisSession) as s:
+        stored = collections.defaultdict(set)
+        stored_dirs = collections.defaultdict(set)
+        # video links and review flags set since the last registration survive re-registering a file
+        kept = {}
+        placed = {}
+        # what a channel registered for the first time gets in those columns; one executemany needs
+        # every row to carry the same keys
+        fresh = {'video_file_path': None, 'reviewed': False}
+        candidate_dirs = collections.defaultdict(set)
+        for thispath, fname in candidates:
+            candidate_dirs[fname].add(thispath)
+        names = list(candidate_dirs)
+        for fileTable in (DataFiles, unusedDataFiles):
+            kept_columns = [col for col in fresh if hasattr(fileTable, col)]
+            for i in range(0, len(names), _MAX_SQL_PARAMS):
+                for row in s.query(fileTable).filter(fileTable.file_name.in_(names[i:i + _MAX_SQL_PARAMS])):
+                    stored[(row.file_path, row.file_name)].add((row.file_size, row.file_mtime))
+                    stored_dirs[row.file_name].add(row.file_path)
+                    kept[(row.animal, row.file_name)] = dict((col, getattr(row, col)) for col in kept_columns)
+                    placed[(row.animal, row.file_name)] = fileTable
+
+        failed = {}
+        for (thispath, fname), (longfilename, _, _) in candidates.items():
+            others = (candidate_dirs[fname] | set(other for other in stored_dirs[fname]
+                                                  if path.exists(path.join(other, fname)))) - set([thispath])
+            if others:
+                failed[longfilename] = 'file name %s is also used in %s' % (fname, ', '.join(sorted(others)))
+        changed = [key for key, (longfilename, size, mtime) in candidates.items()
+                   if longfilename not in failed and stored.get(key) != set([(size, mtime)])]
+        unchanged = len(candidates) - len(changed) - len(failed)
+
+        start = time.time()
+        pool = ThreadPool(max(1, nThreads))
+        try:
+            headers = pool.map(functools.partial(_ReadHeader, headerReader), [candidates[key][0] for key in changed])
+        finally:
+            pool.close()
+            pool.join()
+        log.info('RegisterDirectory: read %d headers in %.3f s (%d unchanged)', len(changed), time.time() - start,
+                 unchanged)
+
+        rows = collections.defaultdict(list)
+        replaced = []
+        for key, (longfilename, channels, error) in zip(changed, headers):
+            if error is not None:
+                failed[longfilename] = error
+                continue
+            replaced.append(key)
+            for chandata in channels:
+                row = _DataFileRow((longfilename, chandata))
+                row['file_size'] = candidates[key][1]
+                row['file_mtime'] = candidates[key][2]
+                fileTable = placed.get((row['animal'], row['file_name']), thisTable)
+                row.update(kept.get((row['animal'], row['file_name'])) or
+                           dict((col, value) for col, value in fresh.items() if hasattr(fileTable, col)))
+                rows[fileTable].append(row)
+
+        # a file's channel list may have changed, so its previous rows go rather than being merged; with
+        # clashing names failed above, those are all the rows of its name, including ones left by a move
+        replaced_names = [fname for _, fname in replaced if fname in stored_dirs]
+        for fileTable in (DataFiles, unusedDataFiles):
+            for i in range(0, len(replaced_names), _MAX_SQL_PARAMS):
+                s.query(fileTable).filter(fileTable.file_name.in_(replaced_names[i:i + _MAX_SQL_PARAMS])).delete(
+                    synchronize_session=False)
+            if rows[fileTable]:
+                _InsertRows(s, fileTable, rows[fileTable], 'replace')
+            _MarkWritten(s, fileTable)
+    return {'registered': len(replaced), 'channels': sum(len(tableRows) for tableRows in rows.values()),
+            'unchanged': unchanged,
+            'failed': failed}
+
+@_Profiled
+def RemoveFromDb(DBStr=None, thisTable=None, thisFileName=None, thisAnimalName=None, thisDataFile=None, unusedDataFlag=True, AlgPars = None, thisEvent=None,
+                 thisSession=None):
 
     if thisDataFile != None:
         longfilename = thisDataFile[0]
@@ -388,142 +1540,997 @@ def RemoveFromDb(DBStr=None, thisTable=None, thisFileName=None, thisAnimalName=N
         thispath=path.dirname(path.abspath(longfilename))
         fname=path.basename(str(longfilename))
 
-    if thisFileName != None and thisTable != None:
-        if thisTable == 'DataFiles':
-            thisTable = DataFiles
-        elif thisTable == 'unusedDataFiles':
-            thisTable = unusedDataFiles
-
-        entry_query = s.query(thisTable).filter(or_(thisTable.file_name==thisFileName))
-
-    elif thisTable == 'AnimalChannelList' and thisAnimalName != None:
-        entry_query = s.query(AnimalChannelList).filter(AnimalChannelList.compound_animal==thisAnimalName)
-    elif  thisDataFile != None and unusedDataFlag == True:
-        entry_query = s.query(unusedDataFiles).filter(unusedDataFiles.file_name==fname, unusedDataFiles.animal==thischandata.name).all()
-    elif thisDataFile != None and unusedDataFlag == False:
-        entry_query = s.query(DataFiles).filter(DataFiles.file_name==fname, DataFiles.animal==thischandata.name).all()
-    elif thisFileName != None:
-        entry_query = s.query(DataFiles).filter(DataFiles.file_name==thisFileName)
-    elif AlgPars != None:
-        entry_query = s.query(AlgorithmParameters).filter(AlgorithmParameters.animal==AlgPars[0])
-    elif thisAnimalName != None:
-        entry_query = s.query(DataFiles).filter(DataFiles.animal==thisAnimalName)
-
-    elif thisEvent != None:
-        entry_query = s.query(Events).filter(Events.event_start==thisEvent.Start,
-                                                       Events.animal==thisEvent.Animal,
-                                                       Events.filename==path.basename(thisEvent.FileName))
-
-    if entry_query == None or entry_query==[]:
-        return False
-    # elif type(entry_query) is list:
-    #     for this_query in entry_query:
-    #         this_query.delete()
-    else:
-        entry_query.delete()
-    s.commit()
-    s.close()
-    engine.dispose()
+    with DbSession(DBStr, thisSession) as s:
+        if thisFileName != None and thisTable != None:
+            if thisTable == 'DataFiles':
+                thisTable = DataFiles
+            elif thisTable == 'unusedDataFiles':
+                thisTable = unusedDataFiles
+
+            entry_query = s.query(thisTable).filter(or_(thisTable.file_name==thisFileName))
+
+        elif thisTable == 'AnimalChannelList' and thisAnimalName != None:
+            entry_query = s.query(AnimalChannelList).filter(AnimalChannelList.compound_animal==thisAnimalName)
+        elif  thisDataFile != None and unusedDataFlag == True:
+            entry_query = s.query(unusedDataFiles).filter(unusedDataFiles.file_name==fname, unusedDataFiles.animal==thischandata.name).all()
+        elif thisDataFile != None and unusedDataFlag == False:
+            entry_query = s.query(DataFiles).filter(DataFiles.file_name==fname, DataFiles.animal==thischandata.name).all()
+        elif thisFileName != None:
+            entry_query = s.query(DataFiles).filter(DataFiles.file_name==thisFileName)
+        elif AlgPars != None:
+            entry_query = s.query(AlgorithmParameters).filter(AlgorithmParameters.animal==AlgPars[0])
+        elif thisAnimalName != None:
+            entry_query = s.query(DataFiles).filter(DataFiles.animal==thisAnimalName)
+
+        elif thisEvent != None:
+            entry_query = s.query(Events).filter(Events.event_start==thisEvent.Start,
+                                                           Events.animal==thisEvent.Animal,
+                                                           Events.filename==path.basename(thisEvent.FileName))
+
+        if entry_query == None or entry_query==[]:
+            return False
+        # elif type(entry_query) is list:
+        #     for this_query in entry_query:
+        #         this_query.delete()
+        else:
+            entity = entry_query.column_descriptions[0]['entity']
+            if entity is Events:
+                removed = entry_query.with_entities(Events.animal, Events.abs_start).all()
+            animals = None
+            if _snapshots and hasattr(entity, 'animal'):
+                animals = [animal for (animal,) in entry_query.with_entities(entity.animal).distinct()]
+            entry_query.delete()
+            _MarkWritten(s, entity, animals=animals)
+            if entity is Events:
+                _RefreshDailySummary(s, removed)
 
     return entry_query
 
 
-def GetDistinctValues(DBStr=None, TableName = None, ColName=None):
-    import time
-#    start = time.time()
-#    print 'gsv start = ', start
-
-    engine = create_engine(DBStr)
-
-    session = sessionmaker()
-    session.configure(bind=engine)
-    Base.metadata.create_all(engine)
-    s = session()
-    if TableName == 'DataFiles':
-        TableName = DataFiles
-    elif TableName == 'unusedDataFiles':
-        TableName = unusedDataFiles
-    elif TableName == 'AnimalChannelList':
-        TableName = AnimalChannelList
-    if ColName == 'file_name':
-        #stop = time.time() - start
-        #print 'gsv step1 = ', stop
-        distinct_files = []
-        for file in s.query(TableName.file_name).distinct():
-            print file
-            distinct_files.append(str(file[0]))
-        #stop = time.time() - start
-        #print 'gsv step2 = ', stop
-        s.close()
-        engine.dispose()
-        return distinct_files
-    if ColName == 'animal':
-        distinct_animals = []
-        for file in s.query(TableName.animal).distinct():
-            print file
-            distinct_animals.append(str(file[0]))
-        s.close()
-        engine.dispose()
-        return distinct_animals
-    if ColName == 'compound_animal':
-        distinct_animals = []
-        for file in s.query(TableName.compound_animal).distinct():
-            print file
-            distinct_animals.append(str(file[0]))
-        s.close()
-        engine.dispose()
-        return distinct_animals
-    if ColName == 'channel':
-        distinct_animals = []
-        for file in s.query(TableName.channel).distinct():
-            print file
-            distinct_animals.append(str(file[0]))
-        s.close()
-        engine.dispose()
-        return distinct_animals
-    else:
-        print 'no field selected, returning zilch'
-        s.close()
-        engine.dispose()
+@_Profiled
+def GetDistinctValues(DBStr=None, TableName = None, ColName=None, thisSession=None):
+    if ColName not in ('file_name', 'animal', 'compound_animal', 'channel'):
+        print('no field selected, returning zilch')
         return []
+    thisTable = _TABLES[TableName] if TableName in _TABLES else TableName
 
+    def load():
+        with DbSession(DBStr, thisSession, readOnly=True) as s:
+            return [str(value) for (value,) in s.query(getattr(thisTable, ColName)).distinct()]
+    return list(_CachedLookup(DBStr, thisTable.__tablename__, ColName, load))
 
-def GetAllChans(DBStr=None, this_filename=None):
-    engine = create_engine(DBStr)
-
-    session = sessionmaker()
-    session.configure(bind=engine)
-    Base.metadata.create_all(engine)
-    s = session()
 
-    all_chans = s.query(DataFiles).filter(DataFiles.file_name == this_filename).all()
-    s.close()
-    engine.dispose()
+@_Profiled
+def GetAllChans(DBStr=None, this_filename=None):
+    all_chans = _SnapshotRows(DBStr, DataFiles, 'file_name', this_filename)
+    if all_chans is not None:
+        return all_chans
+    with DbSession(DBStr, readOnly=True) as s:
+        all_chans = s.query(DataFiles).filter(DataFiles.file_name == this_filename).all()
     return all_chans
 
+@_Profiled
 def GetAllFiles(DBStr=None, this_animal_name=None):
-    engine = create_engine(DBStr)
+    all_files = _SnapshotRows(DBStr, DataFiles, 'animal', this_animal_name)
+    if all_files is not None:
+        return all_files
+    with DbSession(DBStr, readOnly=True) as s:
+        all_files = s.query(DataFiles).filter(DataFiles.animal == this_animal_name).all()
+    return all_files
 
-    session = sessionmaker()
-    session.configure(bind=engine)
-    Base.metadata.create_all(engine)
-    s = session()
 
-    all_files = s.query(DataFiles).filter(DataFiles.animal == this_animal_name).all()
-    s.close()
-    engine.dispose()
-    return all_files
+@_Profiled
+def GetAllSeizures(DBStr=None, this_animal_name=None, thisSession=None):
+    if thisSession is None:
+        all_szrs = _SnapshotRows(DBStr, Events, 'animal', this_animal_name)
+        if all_szrs is not None:
+            return all_szrs
+    with DbSession(DBStr, thisSession, readOnly=True) as s:
+        all_szrs = s.query(Events).filter(Events.animal == this_animal_name).all()
+    return all_szrs
+
 
+def _StreamRows(DBStr, thisTable, whereclause, columns=None, batch_size=1000):
+    # column-projected rows fetched batch_size at a time; rows are plain named tuples, not ORM
+    # instances, so nothing goes through the identity map and only one batch is held at once
+    table_cols = thisTable.__table__.c
+    if columns is None:
+        columns = [col.name for col in table_cols]
+    unknown = [name for name in columns if name not in table_cols]
+    if unknown:
+        raise ValueError('%s has no column(s) %s' % (thisTable.__tablename__, ', '.join(unknown)))
+
+    with DbSession(DBStr, readOnly=True) as s:
+        query = s.query(*[getattr(thisTable, name) for name in columns]).filter(whereclause)
+        for row in query.yield_per(batch_size):
+            yield row
+
+
+@_Profiled
+def IterAllChans(DBStr=None, this_filename=None, columns=None, batch_size=1000):
+    return _StreamRows(DBStr, DataFiles, DataFiles.file_name == this_filename, columns, batch_size)
+
+@_Profiled
+def IterAllFiles(DBStr=None, this_animal_name=None, columns=None, batch_size=1000):
+    return _StreamRows(DBStr, DataFiles, DataFiles.animal == this_animal_name, columns, batch_size)
+
+@_Profiled
+def IterAllSeizures(DBStr=None, this_animal_name=None, columns=None, batch_size=1000):
+    return _StreamRows(DBStr, Events, Events.animal == this_animal_name, columns, batch_size)
+
+
+################################ Algorithm parameters ################################
+
+# detection settings per animal, read by the detectors for every file and channel. All animals are
+# loaded with one query and cached per database; the cache is dropped when a DBlib write to
+# AlgorithmParameters commits, or explicitly with InvalidateCache(DBStr, 'AlgorithmParameters')
+_PARAMETER_COLUMNS = [col.name for col in AlgorithmParameters.__table__.c if col.name != 'animal']
+
+
+def _ParameterValues(pars):
+    # {column: value} from an AlgorithmParameters object or a dict
+    if isinstance(pars, dict):
+        return dict((name, pars[name]) for name in _PARAMETER_COLUMNS if name in pars)
+    return dict((name, getattr(pars, name)) for name in _PARAMETER_COLUMNS)
+
+
+def _LoadParameters(DBStr):
+    def load():
+        with DbSession(DBStr, readOnly=True) as s:
+            table = AlgorithmParameters.__table__
+            return dict((row.animal, dict((name, row[name]) for name in _PARAMETER_COLUMNS))
+                        for row in s.execute(select([table])))
+    return _CachedLookup(DBStr, 'AlgorithmParameters', 'all', load)
+
+
+def _VersionValue(value):
+    # the class defaults are ints but Float columns read back as floats; both must fingerprint alike
+    if isinstance(value, numbers.Integral) and not isinstance(value, bool):
+        return float(value)
+    return value
+
+
+def ParameterVersion(pars):
+    # short, stable fingerprint of a parameter set (AlgorithmParameters object or dict of its columns);
+    # equal settings give equal versions whatever the animal
+    values = _ParameterValues(pars)
+    text_form = ';'.join('%s=%r' % (name, _VersionValue(values.get(name))) for name in _PARAMETER_COLUMNS)
+    return hashlib.sha1(text_form.encode('utf-8')).hexdigest()[:16]
+
+
+@_Profiled
+def GetAlgorithmParameters(DBStr=None, thisAnimal=None, useDefaults=True):
+    # thisAnimal's AlgorithmParameters, or {animal: AlgorithmParameters} for every animal when thisAnimal
+    # is None. An animal with nothing stored gets the class defaults, or None if useDefaults is False.
+    # The objects are new each call, so callers can change them without touching the cache
+    stored = _LoadParameters(DBStr)
+
+    def build(animal):
+        if animal not in stored:
+            return AlgorithmParameters(animal) if useDefaults else None
+        pars = AlgorithmParameters(animal)
+        for name, value in stored[animal].items():
+            setattr(pars, name, value)
+        return pars
+
+    if thisAnimal is None:
+        return dict((animal, build(animal)) for animal in stored)
+    return build(thisAnimal)
+
+
+@_Profiled
+def UpsertAlgorithmParameters(DBStr=None, parameterSets=None, thisSession=None):
+    # bulk insert-or-update: parameterSets maps an animal to an AlgorithmParameters object or a dict of
+    # the columns to change. Columns a dict leaves out keep their stored value, or the class default for
+    # a new animal. One executemany statement in one transaction; returns the number of animals written
+    parameterSets = parameterSets or {}
+    if not parameterSets:
+        return 0
+    unknown = set(name for values in parameterSets.values() if isinstance(values, dict)
+                  for name in values if name not in _PARAMETER_COLUMNS)
+    if unknown:
+        raise ValueError('AlgorithmParameters has no column(s) %s' % ', '.join(sorted(unknown)))
+
+    table = AlgorithmParameters.__table__
+    with DbSession(DBStr, thisSession) as s:
+        stored = {}
+        animals = list(parameterSets)
+        for i in range(0, len(animals), _MAX_SQL_PARAMS):
+            for row in s.execute(select([table]).where(table.c.animal.in_(animals[i:i + _MAX_SQL_PARAMS]))):
+                stored[row.animal] = dict((name, row[name]) for name in _PARAMETER_COLUMNS)
+        rows = []
+        for animal, pars in parameterSets.items():
+            row = stored.get(animal) or _ParameterValues(AlgorithmParameters(animal))
+            row.update(_ParameterValues(pars))
+            row['animal'] = animal
+            rows.append(row)
+        _InsertRows(s, AlgorithmParameters, rows, 'replace')
+        _MarkWritten(s, AlgorithmParameters, animals=animals)
+    return len(rows)
+
+
+@_Profiled
+def FilesToDetect(DBStr=None, thisAnimal=None, filenames=None, paramVersion=None):
+    # the filenames (as given, in order) that thisAnimal has no DetectionRuns row for with paramVersion,
+    # i.e. the ones a detection rerun with those parameters still has to do. Files with events stored
+    # under paramVersion count as done too, which covers events written before DetectionRuns existed
+    if paramVersion is None:
+        paramVersion = ParameterVersion(GetAlgorithmParameters(DBStr, thisAnimal))
+    with DbSession(DBStr, readOnly=True) as s:
+        done = set(filename for (filename,) in s.query(DetectionRuns.filename).filter(
+            DetectionRuns.animal == thisAnimal, DetectionRuns.param_version == paramVersion))
+        done.update(filename for (filename,) in s.query(Events.filename).filter(
+            Events.animal == thisAnimal, Events.param_version == paramVersion).distinct())
+    return [filename for filename in filenames if path.basename(filename) not in done]
+
+
+################################ Time-window queries ################################
+
+def _WindowQuery(s, thisAnimal, thisFilename, columns):
+    # absolute windows range over (animal, abs_start); file-relative ones over the (animal, filename,
+    # event_start) key. Returns the query plus the start/end columns to filter on
+    if columns is None:
+        columns = [col.name for col in Events.__table__.c]
+    query = s.query(*[getattr(Events, name) for name in columns]).filter(Events.animal == thisAnimal)
+    if thisFilename is None:
+        return query, Events.abs_start, Events.abs_end
+    query = query.filter(Events.filename == path.basename(thisFilename))
+    return query, Events.event_start, Events.event_end
+
+
+def _LongestEvent(thisAnimal):
+    # the animal's longest event as a scalar subquery: it bounds how far before a window an overlapping
+    # event can start, which turns the overlap test into an index range. Being part of the window query
+    # it sees every event committed so far, by any process, and ix_Events_animal_duration answers it
+    # with one index probe
+    longest = Events.__table__.alias('longest')
+    stmt = select([func.coalesce(func.max(longest.c.event_end - longest.c.event_start), 0.0)]).where(
+        longest.c.animal == thisAnimal)
+    # as_scalar was renamed scalar_subquery in SQLAlchemy 1.4
+    return stmt.scalar_subquery() if hasattr(stmt, 'scalar_subquery') else stmt.as_scalar()
+
+
+@_Profiled
+def FindEventsOverlapping(DBStr=None, thisAnimal=None, windowStart=None, windowEnd=None, thisFilename=None, columns=None):
+    # events for thisAnimal overlapping [windowStart, windowEnd]. Without thisFilename the window is
+    # absolute (datetimes or epoch seconds, compared with abs_start/abs_end); with it the window is in
+    # seconds from the start of that file. Returns row tuples ordered by start time
+    if thisFilename is None:
+        windowStart, windowEnd = _EpochSeconds(windowStart), _EpochSeconds(windowEnd)
+    with DbSession(DBStr, readOnly=True) as s:
+        query, start_col, end_col = _WindowQuery(s, thisAnimal, thisFilename, columns)
+        return query.filter(start_col.between(windowStart - _LongestEvent(thisAnimal), windowEnd),
+                            end_col >= windowStart).order_by(start_col).all()
+
+
+@_Profiled
+def FindEventsWithin(DBStr=None, thisAnimal=None, windowStart=None, windowEnd=None, thisFilename=None, columns=None):
+    # events lying entirely inside [windowStart, windowEnd]; same time conventions as FindEventsOverlapping
+    if thisFilename is None:
+        windowStart, windowEnd = _EpochSeconds(windowStart), _EpochSeconds(windowEnd)
+    with DbSession(DBStr, readOnly=True) as s:
+        query, start_col, end_col = _WindowQuery(s, thisAnimal, thisFilename, columns)
+        return query.filter(start_col.between(windowStart, windowEnd),
+                            end_col <= windowEnd).order_by(start_col).all()
+
+
+@_Profiled
+def FindNearestEvent(DBStr=None, thisAnimal=None, thisTime=None, thisFilename=None, columns=None):
+    # the event closest to thisTime: one containing it if there is one, otherwise whichever of the
+    # last event ending before it and the first event starting after it is nearer. None if no events
+    if thisFilename is None:
+        thisTime = _EpochSeconds(thisTime)
+    with DbSession(DBStr, readOnly=True) as s:
+        query, start_col, end_col = _WindowQuery(s, thisAnimal, thisFilename, None)
+        after = query.filter(start_col > thisTime).order_by(start_col).first()
+        last_before = query.filter(start_col <= thisTime).order_by(start_col.desc()).first()
+        candidates = [after] if after is not None else []
+        if last_before is not None:
+            # anything ending later than last_before must have started within the longest event of it
+            earliest = _StartOf(last_before, thisFilename) - _LongestEvent(thisAnimal)
+            candidates += query.filter(start_col.between(earliest, thisTime)).all()
+        if not candidates:
+            return None
+
+        def distance(row):
+            start, end = _StartOf(row, thisFilename), _EndOf(row, thisFilename)
+            return max(start - thisTime, thisTime - end, 0.0)
+        nearest = min(candidates, key=distance)
+        if columns is None:
+            return nearest
+        return query.with_entities(*[getattr(Events, name) for name in columns]).filter(
+            Events.filename == nearest.filename, Events.event_start == nearest.event_start).first()
+
+
+def _StartOf(row, thisFilename):
+    return row.event_start if thisFilename is not None else row.abs_start
+
+
+def _EndOf(row, thisFilename):
+    return row.event_end if thisFilename is not None else row.abs_end
+
+
+################################ Columnar export / import ################################
+
+def _NumpyDtype(col):
+    # integers come back as float so that NULL can be NaN
+    if isinstance(col.type, Boolean):
+        return '?'
+    if isinstance(col.type, (Integer, Float)):
+        return 'f8'
+    if isinstance(col.type, DateTime):
+        return 'M8[us]'
+    return 'O'
+
+
+def _ArrowType(col, pa):
+    if isinstance(col.type, Boolean):
+        return pa.bool_()
+    if isinstance(col.type, Integer):
+        return pa.int64()
+    if isinstance(col.type, Float):
+        return pa.float64()
+    if isinstance(col.type, DateTime):
+        return pa.timestamp('us')
+    return pa.string()
+
+
+def _ColumnarSelect(thisTable, columns=None, thisAnimal=None, windowStart=None, windowEnd=None):
+    # Core select (no ORM hydration) over thisTable, optionally narrowed to one animal or a list of
+    # animals and to a time window: overlapping events for Events, files starting inside it otherwise
+    table = thisTable.__table__
+    if columns is None:
+        columns = [col.name for col in table.c]
+    unknown = [name for name in columns if name not in table.c]
+    if unknown:
+        raise ValueError('%s has no column(s) %s' % (table.name, ', '.join(unknown)))
+
+    stmt = select([table.c[name] for name in columns])
+    if thisAnimal is not None:
+        if isinstance(thisAnimal, (list, tuple, set)):
+            stmt = stmt.where(table.c.animal.in_(list(thisAnimal)))
+        else:
+            stmt = stmt.where(table.c.animal == thisAnimal)
+    if thisTable is Events:
+        if windowStart is not None:
+            stmt = stmt.where(table.c.abs_end >= _EpochSeconds(windowStart))
+        if windowEnd is not None:
+            stmt = stmt.where(table.c.abs_start <= _EpochSeconds(windowEnd))
+    else:
+        if windowStart is not None:
+            stmt = stmt.where(table.c.file_start >= windowStart)
+        if windowEnd is not None:
+            stmt = stmt.where(table.c.file_start <= windowEnd)
+    return stmt, columns
+
+
+@_Profiled
+def ExportColumns(DBStr=None, thisTable='Events', thisAnimal=None, windowStart=None, windowEnd=None,
+                  columns=None, asDataFrame=False):
+    # rows of thisTable as a NumPy structured array (or a pandas DataFrame), read straight from a
+    # Core select. Window times are datetimes or epoch seconds, as for FindEventsOverlapping
+    import numpy as np
+
+    thisTable = _TABLES[thisTable]
+    stmt, columns = _ColumnarSelect(thisTable, columns, thisAnimal, windowStart, windowEnd)
+    with GetReadEngine(DBStr).connect() as conn:
+        rows = conn.execute(stmt).fetchall()
+
+    table_cols = thisTable.__table__.c
+    dtype = [(str(name), _NumpyDtype(table_cols[name])) for name in columns]
+    out = np.empty(len(rows), dtype=dtype)
+    if rows:
+        for (name, col_dtype), values in zip(dtype, zip(*rows)):
+            out[name] = np.array(values, dtype=col_dtype)
+    if asDataFrame:
+        import pandas
+        return pandas.DataFrame(out)
+    return out
+
+
+@_Profiled
+def ExportParquet(DBStr=None, filePath=None, thisTable='Events', thisAnimal=None, windowStart=None, windowEnd=None,
+                  chunk_size=100000):
+    # streams thisTable to a Parquet file, one row group per chunk_size rows. Returns the rows written
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    thisTable = _TABLES[thisTable]
+    stmt, columns = _ColumnarSelect(thisTable, None, thisAnimal, windowStart, windowEnd)
+    table_cols = thisTable.__table__.c
+    schema = pa.schema([pa.field(name, _ArrowType(table_cols[name], pa)) for name in columns])
+
+    n_rows = 0
+    writer = pq.ParquetWriter(filePath, schema)
+    try:
+        with GetReadEngine(DBStr).connect() as conn:
+            result = conn.execute(stmt)
+            while True:
+                rows = result.fetchmany(chunk_size)
+                if not rows:
+                    break
+                arrays = [pa.array(list(values), type=col_type) for values, col_type in zip(zip(*rows), schema.types)]
+                writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+                n_rows += len(rows)
+    finally:
+        writer.close()
+    return n_rows
+
+
+@_Profiled
+def ImportParquet(DBStr=None, filePath=None, thisTable='Events', onConflict='ignore', chunk_size=100000):
+    # bulk-loads a file written by ExportParquet, a row group at a time, in one transaction.
+    # Columns the table doesn't have are ignored. Returns the rows read
+    import pyarrow.parquet as pq
+
+    thisTable = _TABLES[thisTable]
+    known_cols = thisTable.__table__.c
+    parquet_file = pq.ParquetFile(filePath)
+    n_rows = 0
+    with DbSession(DBStr) as s:
+        for i in range(parquet_file.num_row_groups):
+            row_group = parquet_file.read_row_group(i)
+            names = [name for name in row_group.schema.names if name in known_cols]
+            rows = [dict(zip(names, values))
+                    for values in zip(*[row_group.column(name).to_pylist() for name in names])]
+            for j in range(0, len(rows), chunk_size):
+                _InsertRows(s, thisTable, rows[j:j + chunk_size], onConflict)
+            if thisTable is Events:
+                _RefreshDailySummary(s, [(row.get('animal'), row.get('abs_start')) for row in rows])
+            n_rows += len(rows)
+        _MarkWritten(s, thisTable)
+    return n_rows
+
+
+@_Profiled
+def ExportDatabaseParquet(DBStr=None, dirPath=None, chunk_size=100000):
+    # every DBlib table to <dirPath>/<table>.parquet, for moving whole databases between machines
+    return dict((name, ExportParquet(DBStr, path.join(dirPath, name + '.parquet'), name, chunk_size=chunk_size))
+                for name in _TABLES)
+
+
+@_Profiled
+def ImportDatabaseParquet(DBStr=None, dirPath=None, onConflict='ignore', chunk_size=100000):
+    return dict((name, ImportParquet(DBStr, path.join(dirPath, name + '.parquet'), name, onConflict, chunk_size))
+                for name in _TABLES if path.exists(path.join(dirPath, name + '.parquet')))
+
+
+################################ Event merging ################################
+
+@_Profiled
+def MergeEvents(DBStr=None, thisAnimal=None, proxThreshold=None, durationThreshold=None, howFound='auto'):
+    # joins thisAnimal's events that are less than proxThreshold seconds apart within a file and drops
+    # those shorter than durationThreshold seconds; both default to the animal's AlgorithmParameters.
+    # The whole animal is done at once with NumPy and written back in one transaction: the first event
+    # of a merged run takes the run's end and edit_status 'j', the rest of the run and every event that
+    # is too short get 'd'. Events already marked 'd' are left out, as are events not found by howFound
+    # (None takes every event). Returns counts of joined runs, absorbed events and dropped events
+    import numpy as np
+
+    events = Events.__table__
+    counts = {'joined': 0, 'absorbed': 0, 'dropped': 0}
+    if proxThreshold is None or durationThreshold is None:
+        pars = GetAlgorithmParameters(DBStr, thisAnimal)
+        if proxThreshold is None:
+            proxThreshold = pars.proxthreshold
+        if durationThreshold is None:
+            durationThreshold = pars.durationthreshold
+    with DbSession(DBStr) as s:
+
+        stmt = select([events.c.filename, events.c.event_start, events.c.event_end, events.c.file_start,
+                       events.c.abs_start]).where(
+            (events.c.animal == thisAnimal) & or_(events.c.edit_status == None, events.c.edit_status != 'd'))
+        if howFound is not None:
+            stmt = stmt.where(events.c.how_found == howFound)
+        rows = s.execute(stmt.order_by(events.c.filename, events.c.event_start)).fetchall()
+        if not rows:
+            return counts
+
+        filenames, starts, ends, file_starts, abs_starts = zip(*rows)
+        n = len(rows)
+        filenames = np.array(filenames, dtype=object)
+        start = np.array(starts, dtype='f8')
+        end = np.array(ends, dtype='f8')
+        end = np.where(np.isnan(end), start, end)
+
+        # shift each file onto its own stretch of the time axis so one running max covers every file
+        new_file = np.ones(n, dtype=bool)
+        new_file[1:] = filenames[1:] != filenames[:-1]
+        span = end.max() - start.min() + proxThreshold + 1.0
+        offset = (np.cumsum(new_file) - 1) * span
+        run_end = np.maximum.accumulate(end + offset)
+
+        new_group = np.ones(n, dtype=bool)
+        new_group[1:] = (start[1:] + offset[1:]) - run_end[:-1] > proxThreshold
+        firsts = np.flatnonzero(new_group)
+        group_id = np.cumsum(new_group) - 1
+        group_size = np.diff(np.append(firsts, n))
+        group_end = np.maximum.reduceat(end, firsts)
+        keep = group_end - start[firsts] >= durationThreshold
+
+        joined = firsts[keep & (group_size > 1)]
+        removed = np.flatnonzero(~keep[group_id] | (~new_group & keep[group_id]))
+        counts['joined'] = len(joined)
+        counts['dropped'] = int(np.sum(group_size[~keep]))
+        counts['absorbed'] = len(removed) - counts['dropped']
+
+        pk_match = ((events.c.animal == bindparam('b_animal')) & (events.c.filename == bindparam('b_filename')) &
+                    (events.c.event_start == bindparam('b_start')))
+        if len(joined):
+            new_ends = group_end[group_id[joined]]
+            s.execute(events.update().where(pk_match).values(event_end=bindparam('b_end'), abs_end=bindparam('b_abs_end'),
+                                                             edit_status='j'),
+                      [{'b_animal': thisAnimal, 'b_filename': filenames[i], 'b_start': float(start[i]),
+                        'b_end': float(new_end), 'b_abs_end': _AbsTimes(file_starts[i], None, float(new_end))[1]}
+                       for i, new_end in zip(joined, new_ends)])
+        if len(removed):
+            s.execute(events.update().where(pk_match).values(edit_status='d'),
+                      [{'b_animal': thisAnimal, 'b_filename': filenames[i], 'b_start': float(start[i])}
+                       for i in removed])
+        _MarkWritten(s, Events, animals=[thisAnimal])
+        _RefreshDailySummary(s, [(thisAnimal, abs_starts[i]) for i in np.append(joined, removed)])
+    return counts
+
+
+################################ Aggregates and daily summary ################################
+
+_DAY_S = 86400.0
+
+
+def _DayNumber(abs_start):
+    # whole days since 1970-01-01 on the abs_start clock; truncates the same way as the SQL CAST below
+    return int(abs_start / _DAY_S)
+
+
+def _NotDropped():
+    return or_(Events.edit_status == None, Events.edit_status != 'd')
+
+
+def _DailyCounts(s, *criteria):
+    # per animal per day event counts straight from Events, as DailySeizureSummary row dicts
+    day_number = cast(Events.abs_start / _DAY_S, Integer)
+    query = s.query(Events.animal, day_number, func.count(), func.sum(func.coalesce(Events.event_end, Events.event_start) -
+                                                                      Events.event_start),
+                    func.count(Events.racine_score), func.sum(Events.racine_score), func.max(Events.racine_score))
+    query = query.filter(Events.abs_start != None, _NotDropped(), *criteria).group_by(Events.animal, day_number)
+    return [{'animal': animal, 'day': (_EPOCH + datetime.timedelta(days=n)).date(), 'n_events': n_events,
+             'total_duration': total_duration or 0.0, 'n_scored': n_scored, 'racine_total': racine_total,
+             'max_racine': max_racine}
+            for animal, n, n_events, total_duration, n_scored, racine_total, max_racine in query]
+
+
+def _SummaryEnabled(s):
+    # asked of the database on s's own connection every time, not remembered, so a summary enabled or
+    # disabled by another process is seen by the next transaction here
+    return s.get_bind().dialect.has_table(s.connection(), DailySeizureSummary.__tablename__)
+
+
+def _RefreshDailySummary(s, animal_starts):
+    # recounts the summary rows for the days of the (animal, abs_start) pairs just written or removed,
+    # inside the writer's own transaction. Each recount is an index range over (animal, abs_start), so
+    # it costs the events of the touched days rather than the whole table. The summary table is looked
+    # for after the flush, once this transaction holds the write lock: if another process enables the
+    # summary, either it committed first and is seen here, or its rebuild runs after this commit
+    days = collections.defaultdict(set)
+    for animal, abs_start in animal_starts:
+        if animal is not None and abs_start is not None:
+            days[animal].add(_DayNumber(abs_start))
+    if not days:
+        return
+    s.flush()
+    if not _SummaryEnabled(s):
+        return
+    summary = DailySeizureSummary.__table__
+    for animal, day_numbers in days.items():
+        day_numbers = sorted(day_numbers)
+        for i in range(0, len(day_numbers), _MAX_SQL_PARAMS):
+            these_days = day_numbers[i:i + _MAX_SQL_PARAMS]
+            dates = set((_EPOCH + datetime.timedelta(days=n)).date() for n in these_days)
+            rows = [row for row in _DailyCounts(s, Events.animal == animal,
+                                                Events.abs_start >= these_days[0] * _DAY_S,
+                                                Events.abs_start < (these_days[-1] + 1) * _DAY_S)
+                    if row['day'] in dates]
+            s.execute(summary.delete().where(and_(summary.c.animal == animal, summary.c.day.in_(dates))))
+            if rows:
+                s.execute(summary.insert(), rows)
+
+
+@_Profiled
+def EnableDailySummary(DBStr=None):
+    # creates DailySeizureSummary if needed and (re)builds it from Events; from then on AddToDb, AddEvents,
+    # RemoveFromDb, MergeEvents, ImportParquet and DbWriter keep it current. Returns the summary rows written
+    # writers in any process start keeping it current with their next transaction
+    DailySeizureSummary.__table__.create(GetEngine(DBStr), checkfirst=True)
+    summary = DailySeizureSummary.__table__
+    with DbSession(DBStr) as s:
+        s.execute(summary.delete())
+        rows = _DailyCounts(s)
+        if rows:
+            s.execute(summary.insert(), rows)
+    return len(rows)
+
+
+@_Profiled
+def DisableDailySummary(DBStr=None):
+    DailySeizureSummary.__table__.drop(GetEngine(DBStr), checkfirst=True)
+
+
+@_Profiled
+def DailySeizureBurden(DBStr=None, thisAnimal=None, startDay=None, endDay=None):
+    # events per animal per day between startDay and endDay (datetime.date, inclusive), as
+    # DailySeizureSummary row dicts sorted by animal and day. Read from the summary table when it is
+    # enabled, otherwise grouped in SQL from Events; both give the same rows
+    with DbSession(DBStr, readOnly=True) as s:
+        if _SummaryEnabled(s):
+            query = s.query(DailySeizureSummary)
+            if thisAnimal is not None:
+                query = query.filter(DailySeizureSummary.animal == thisAnimal)
+            if startDay is not None:
+                query = query.filter(DailySeizureSummary.day >= startDay)
+            if endDay is not None:
+                query = query.filter(DailySeizureSummary.day <= endDay)
+            cols = [col.name for col in DailySeizureSummary.__table__.c]
+            return [dict((name, getattr(row, name)) for name in cols)
+                    for row in query.order_by(DailySeizureSummary.animal, DailySeizureSummary.day)]
+
+        criteria = []
+        if thisAnimal is not None:
+            criteria.append(Events.animal == thisAnimal)
+        if startDay is not None:
+            criteria.append(Events.abs_start >= _EpochSeconds(datetime.datetime.combine(startDay, datetime.time())))
+        if endDay is not None:
+            criteria.append(Events.abs_start < _EpochSeconds(datetime.datetime.combine(endDay, datetime.time())) + _DAY_S)
+        return sorted(_DailyCounts(s, *criteria), key=lambda row: (row['animal'], row['day']))
+
+
+@_Profiled
+def SeizureTotals(DBStr=None, thisAnimal=None):
+    # {animal: {'n_events', 'total_duration', 'mean_racine'}} over every event not marked 'd';
+    # mean_racine only averages scored events and is None if there are none
+    with DbSession(DBStr, readOnly=True) as s:
+        query = s.query(Events.animal, func.count(),
+                        func.sum(func.coalesce(Events.event_end, Events.event_start) - Events.event_start),
+                        func.avg(Events.racine_score)).filter(_NotDropped())
+        if thisAnimal is not None:
+            query = query.filter(Events.animal == thisAnimal)
+        return dict((animal, {'n_events': n_events, 'total_duration': total_duration or 0.0, 'mean_racine': mean_racine})
+                    for animal, n_events, total_duration, mean_racine in query.group_by(Events.animal))
+
+
+@_Profiled
+def RacineHistogram(DBStr=None, thisAnimal=None):
+    # {animal: {racine_score: count}} over events not marked 'd'; unscored events count under None
+    histogram = collections.defaultdict(dict)
+    with DbSession(DBStr, readOnly=True) as s:
+        query = s.query(Events.animal, Events.racine_score, func.count()).filter(_NotDropped())
+        if thisAnimal is not None:
+            query = query.filter(Events.animal == thisAnimal)
+        for animal, score, count in query.group_by(Events.animal, Events.racine_score):
+            histogram[animal][score] = count
+    return dict(histogram)
+
+
+@_Profiled
+def ReviewedFraction(DBStr=None, thisAnimal=None):
+    # {animal: (reviewed files, files, fraction reviewed)} from DataFiles
+    with DbSession(DBStr, readOnly=True) as s:
+        query = s.query(DataFiles.animal, func.count(), func.sum(func.coalesce(cast(DataFiles.reviewed, Integer), 0)))
+        if thisAnimal is not None:
+            query = query.filter(DataFiles.animal == thisAnimal)
+        return dict((animal, (int(reviewed or 0), n_files, float(reviewed or 0) / n_files))
+                    for animal, n_files, reviewed in query.group_by(DataFiles.animal))
+
+
+################################ Single-writer ingestion ################################
+
+class DbWriter(object):
+    # the one process that writes to DBStr while detection runs in parallel. Producers, in this
+    # process or any other, hand records to a DbWriterClient; a thread here drains the bounded
+    # request queue, coalesces submissions into one transaction per batchSize rows or per
+    # flushInterval seconds, drops events whose (animal, filename, event_start) is already stored
+    # or already queued, and posts an acknowledgement per submission. When maxPending submissions
+    # are waiting, Submit blocks, which is the producers' backpressure.
+    #
+    #     with DbWriter(DBStr) as writer:
+    #         pool = multiprocessing.Pool(initializer=InitDetector, initargs=(writer.Client(),))
+    #         ...
+
+    def __init__(self, DBStr=None, batchSize=5000, flushInterval=1.0, maxPending=100):
+        self.DBStr = DBStr
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self._manager = multiprocessing.Manager()
+        self._requests = self._manager.Queue(maxPending)
+        self._acks = self._manager.dict()
+        self._thread = None
+
+    def Client(self):
+        return DbWriterClient(self._requests, self._acks)
+
+    def Start(self):
+        GetEngine(self.DBStr)
+        self._thread = threading.Thread(target=self._Run, name='DbWriter')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def Stop(self):
+        # flushes everything already submitted, then shuts the queue down
+        if self._thread is not None:
+            self._requests.put(None)
+            self._thread.join()
+            self._thread = None
+        self._manager.shutdown()
+
+    def __enter__(self):
+        return self.Start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Stop()
+
+    def _Run(self):
+        pending = []
+        pending_rows = 0
+        first_pending = None
+        while True:
+            if pending:
+                wait = max(0.0, first_pending + self.flushInterval - time.time())
+            else:
+                wait = self.flushInterval
+            try:
+                request = self._requests.get(timeout=wait)
+            except Empty:
+                request = False
+            if request is None:
+                self._Flush(pending)
+                return
+            if request:
+                if not pending:
+                    first_pending = time.time()
+                pending.append(request)
+                pending_rows += len(request[1]) + len(request[2]) + len(request[4])
+            if pending and (pending_rows >= self.batchSize or time.time() - first_pending >= self.flushInterval):
+                self._Flush(pending)
+                pending = []
+                pending_rows = 0
+
+    def _Flush(self, pending):
+        if not pending:
+            return
+        acks = {}
+        try:
+            with DbSession(self.DBStr) as s:
+                existing = _ExistingKeys(s, Events, set((row['animal'], row['filename'], row['event_start'])
+                                                        for request in pending for row in request[1]))
+                seen = set()
+                rows_by_table = {Events: [], DataFiles: [], unusedDataFiles: [], DetectionRuns: []}
+                for ticket, event_rows, datafile_rows, unusedDataFlag, run_rows in pending:
+                    duplicates = 0
+                    for row in event_rows:
+                        key = (row['animal'], row['filename'], row['event_start'])
+                        if key in existing or key in seen:
+                            duplicates += 1
+                            continue
+                        seen.add(key)
+                        rows_by_table[Events].append(row)
+                    rows_by_table[unusedDataFiles if unusedDataFlag else DataFiles].extend(datafile_rows)
+                    rows_by_table[DetectionRuns].extend(run_rows)
+                    acks[ticket] = {'events': len(event_rows) - duplicates, 'duplicates': duplicates,
+                                    'datafiles': len(datafile_rows), 'error': None}
+                # files go in first, so events submitted along with their file find its file_start
+                for thisTable in (DataFiles, unusedDataFiles, Events, DetectionRuns):
+                    rows = rows_by_table[thisTable]
+                    if thisTable is Events:
+                        file_starts = _FileStarts(s, set(row['filename'] for row in rows if row['file_start'] is None))
+                        for row in rows:
+                            if row['file_start'] is None:
+                                row['file_start'] = file_starts.get(row['filename'])
+                                row['abs_start'], row['abs_end'] = _AbsTimes(row['file_start'], row['event_start'],
+                                                                             row['event_end'])
+                    for i in range(0, len(rows), self.batchSize):
+                        _InsertRows(s, thisTable, rows[i:i + self.batchSize], 'ignore')
+                    if rows:
+                        _MarkWritten(s, thisTable, animals=set(row['animal'] for row in rows))
+                _RefreshDailySummary(s, [(row['animal'], row['abs_start']) for row in rows_by_table[Events]])
+        except Exception as e:
+            acks = dict((request[0], {'events': 0, 'duplicates': 0, 'datafiles': 0, 'error': repr(e)})
+                        for request in pending)
+        self._acks.update(acks)
+
+
+class DbWriterClient(object):
+    # producer-side handle on a DbWriter. It only holds manager proxies, so it pickles: pass it to
+    # Pool workers as an argument or through the pool initializer
+
+    def __init__(self, requests, acks):
+        self._requests = requests
+        self._acks = acks
+
+    def Submit(self, events=None, dataFiles=None, unusedDataFlag=True, timeout=None, paramVersion=None,
+               detectedFiles=None):
+        # queue event objects (as for AddToDb(thisEvent=...)) and/or (filename, chandata) pairs; returns
+        # a ticket for Wait. Blocks while the writer is maxPending submissions behind; with a timeout
+        # it raises Queue.Full instead of waiting longer than that. paramVersion and detectedFiles are
+        # as for AddEvents
+        ticket = uuid.uuid4().hex
+        event_rows = [_EventRow(e, paramVersion=paramVersion) for e in (events or [])]
+        run_rows = _DetectionRunRows(event_rows, detectedFiles, paramVersion)
+        self._requests.put((ticket, event_rows, [_DataFileRow(d) for d in (dataFiles or [])], unusedDataFlag,
+                            run_rows), timeout=timeout)
+        return ticket
+
+    def Wait(self, ticket, timeout=None, poll=0.01):
+        # the acknowledgement for ticket once its batch has committed: counts of events inserted,
+        # duplicates skipped and datafiles written, plus 'error' if the transaction failed. None on timeout
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            ack = self._acks.pop(ticket, None)
+            if ack is not None:
+                return ack
+            if deadline is not None and time.time() >= deadline:
+                return None
+            time.sleep(poll)
+
+
+################################ Federated queries ################################
+
+# SQLite's default SQLITE_MAX_ATTACHED
+_MAX_ATTACHED = 10
+
+
+def _ForgetEngines():
+    # pool initializer: a forked worker must open its own connections rather than share the parent's,
+    # so drop the inherited registry without disposing (that would close them under the parent)
+    with _registry_lock:
+        _engines.clear()
+        _session_factories.clear()
+        _engine_dbstrs.clear()
+        _read_engines.clear()
+        _read_session_factories.clear()
+        _schema_checked.clear()
+        _metadata_cache.clear()
+        _cache_versions.clear()
+        _data_version_conns.clear()
+        _snapshots.clear()
+
+
+def _FederatedPool(nProcesses):
+    return multiprocessing.Pool(nProcesses, initializer=_ForgetEngines)
+
+
+def _FederatedCallWorker(job):
+    functionName, DBStr, args, kwargs = job
+    result = globals()[functionName](DBStr, *args, **kwargs)
+    if isinstance(result, types.GeneratorType):
+        result = list(result)
+    return DBStr, result
+
+
+@_Profiled
+def FederatedCall(DBStrs=None, functionName=None, args=(), kwargs=None, nProcesses=None):
+    # runs the DBlib read function functionName(DBStr, *args, **kwargs) on every database, one per
+    # worker process, and yields (DBStr, result) in the order the databases finish. Generator results
+    # (IterAllSeizures etc.) come back as lists. nProcesses=1 runs them in series in this process
+    #     for DBStr, animals in FederatedCall(cohorts, 'GetDistinctValues', ('Events', 'animal')): ...
+    if functionName not in globals() or functionName.startswith('_'):
+        raise ValueError('no DBlib function %s' % functionName)
+    jobs = [(functionName, DBStr, tuple(args), kwargs or {}) for DBStr in DBStrs]
+    if nProcesses == 1:
+        for job in jobs:
+            yield _FederatedCallWorker(job)
+        return
+    pool = _FederatedPool(nProcesses)
+    try:
+        for result in pool.imap_unordered(_FederatedCallWorker, jobs):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _FederatedSelect(table, source, columns, filters, orderBy):
+    # the per-database select behind FederatedRows, against table (the model table or an attached copy)
+    stmt = select([literal(source).label('source')] + [table.c[name] for name in columns])
+    for name, value in filters.items():
+        if isinstance(value, (list, tuple, set, frozenset)):
+            stmt = stmt.where(table.c[name].in_(list(value)))
+        else:
+            stmt = stmt.where(table.c[name] == value)
+    if orderBy is not None:
+        stmt = stmt.order_by(table.c[orderBy])
+    return stmt
+
+
+def _FederatedRowsWorker(job):
+    DBStr, tableName, columns, filters, orderBy = job
+    with DbSession(DBStr, readOnly=True) as s:
+        return [tuple(row) for row in s.execute(_FederatedSelect(_TABLES[tableName].__table__, DBStr, columns,
+                                                                 filters, orderBy))]
+
+
+def _AttachedRows(DBStrs, tableName, columns, filters, orderBy, batchSize):
+    # one in-memory connection with up to _MAX_ATTACHED databases attached, queried as a single UNION ALL
+    table = _TABLES[tableName].__table__
+    engine = create_engine('sqlite://')
+    conn = engine.connect()
+    try:
+        conn.execute('PRAGMA query_only = ON')
+        selects = []
+        for i, DBStr in enumerate(DBStrs):
+            GetEngine(DBStr)
+            schema = 'src%d' % i
+            conn.execute(text('ATTACH DATABASE :db AS %s' % schema), db=make_url(DBStr).database)
+            selects.append(_FederatedSelect(table.tometadata(MetaData(), schema=schema), DBStr, columns,
+                                            filters, None))
+        stmt = union_all(*selects)
+        if orderBy is not None:
+            stmt = stmt.order_by(orderBy)
+        result = conn.execute(stmt)
+        while True:
+            rows = result.fetchmany(batchSize)
+            if not rows:
+                break
+            for row in rows:
+                yield tuple(row)
+    finally:
+        conn.close()
+        engine.dispose()
 
-def GetAllSeizures(DBStr=None, this_animal_name=None):
-    engine = create_engine(DBStr)
 
-    session = sessionmaker()
-    session.configure(bind=engine)
-    Base.metadata.create_all(engine)
-    s = session()
+@_Profiled
+def FederatedRows(DBStrs=None, thisTable='Events', filters=None, columns=None, orderBy=None, mode='attach',
+                  batchSize=1000, nProcesses=None):
+    # rows of thisTable from every database in DBStrs as named tuples whose first field, source, is the
+    # DBStr they came from. filters maps a column to a value or a list of values, e.g. every event for a
+    # strain is filters={'animal': strain_animals}. mode='attach' ATTACHes the SQLite files to one
+    # connection _MAX_ATTACHED at a time and runs a UNION ALL per batch; mode='pool' queries each
+    # database in its own worker process. Rows are yielded as each batch or database arrives; with
+    # orderBy they are merged into one ordering on that column instead
+    thisTable = _TABLES[thisTable].__tablename__
+    table_cols = _TABLES[thisTable].__table__.c
+    if columns is None:
+        columns = [col.name for col in table_cols]
+    filters = filters or {}
+    unknown = [name for name in list(columns) + list(filters) + [orderBy] if name is not None and name not in table_cols]
+    if unknown:
+        raise ValueError('%s has no column(s) %s' % (thisTable, ', '.join(unknown)))
+    if orderBy is not None and orderBy not in columns:
+        raise ValueError('orderBy %s has to be one of the columns selected' % orderBy)
+    FederatedRow = collections.namedtuple('FederatedRow', ['source'] + list(columns))
+    DBStrs = list(DBStrs)
+
+    if mode == 'attach':
+        not_files = [DBStr for DBStr in DBStrs if not _IsSqliteFile(DBStr)]
+        if not_files:
+            raise ValueError('mode=attach needs SQLite database files, not %s' % ', '.join(not_files))
+        sources = [_AttachedRows(DBStrs[i:i + _MAX_ATTACHED], thisTable, columns, filters, orderBy, batchSize)
+                   for i in range(0, len(DBStrs), _MAX_ATTACHED)]
+    elif mode == 'pool':
+        pool = _FederatedPool(nProcesses)
+        try:
+            jobs = [(DBStr, thisTable, columns, filters, orderBy) for DBStr in DBStrs]
+            sources = pool.imap(_FederatedRowsWorker, jobs) if orderBy is not None else \
+                      pool.imap_unordered(_FederatedRowsWorker, jobs)
+            sources = list(sources) if orderBy is not None else sources
+        except:
+            pool.terminate()
+            raise
+    else:
+        raise ValueError("mode must be 'attach' or 'pool'")
 
-    all_szrs = s.query(Events).filter(Events.animal == this_animal_name).all()
-    s.close()
-    engine.dispose()
-    return all_szrs
+    try:
+        if orderBy is None:
+            rows = itertools.chain.from_iterable(sources)
+        else:
+            # heapq.merge has no key= in Python 2, so merge (key, source, position, row) tuples; NULLs sort
+            # first as in SQLite, and source and position settle ties without ever comparing rows
+            order_idx = columns.index(orderBy) + 1
+            rows = (item[-1] for item in heapq.merge(*[(((row[order_idx] is not None, row[order_idx]), i, n, row)
+                                                        for n, row in enumerate(source))
+                                                       for i, source in enumerate(sources)]))
+        for row in rows:
+            yield FederatedRow(*row)
+    finally:
+        if mode == 'pool':
+            pool.terminate()
+            pool.join()
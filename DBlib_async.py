@@ -0,0 +1,111 @@
+# asyncio counterparts of the main DBlib calls, for services that run on an event loop.
+#
+#     import DBlib_async
+#     seizures, files = await asyncio.gather(DBlib_async.GetAllSeizures(DBStr, 'rat1_ch1'),
+#                                            DBlib_async.FindInDb(DBStr, 'DataFiles', 'f1.smr', thisAnimal='rat1_ch1'))
+#
+# Python 3 only: needs SQLAlchemy >=1.4,<2.0 (the async engine arrived in 1.4, and DBlib still builds
+# Core queries with the 1.x select([...]) form that 2.0 removed) and the aiosqlite driver, and works
+# on SQLite database files.
+# Each database gets one async engine, so one shared connection pool, and every call takes its own
+# session from it, so gathered calls run side by side. The statements are DBlib's own, run on the
+# async session through run_sync, so the metadata cache, snapshots, the daily summary and profiling
+# see these calls exactly as they see the blocking ones. Call DisposeEngine before the loop closes.
+import asyncio
+
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+import DBlib
+
+# connections per database kept open, and how many more a burst of gathered calls may add
+POOL_SIZE = 5
+MAX_OVERFLOW = 10
+
+_engines = {}
+_session_factories = {}
+_starting = {}
+
+
+async def _StartEngine(DBStr):
+    if not DBlib._IsSqliteFile(DBStr):
+        raise ValueError('DBlib_async needs an SQLite database file, not %s' % DBStr)
+    # create_all and the column migrations are blocking, and only needed once, so they run on a thread
+    await asyncio.get_running_loop().run_in_executor(None, DBlib.GetEngine, DBStr)
+    engine = create_async_engine(make_url(DBStr).set(drivername='sqlite+aiosqlite'),
+                                 poolclass=AsyncAdaptedQueuePool, pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW,
+                                 connect_args=DBlib._EngineArgs(DBStr)['connect_args'])
+    profile = DBlib._connection_profiles.get(DBStr)
+    if profile:
+        DBlib._ApplyConnectionProfile(engine.sync_engine, profile)
+    DBlib._RegisterEngine(DBStr, engine.sync_engine)
+    _engines[DBStr] = engine
+    _session_factories[DBStr] = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+
+async def GetEngine(DBStr=None):
+    # the async engine for DBStr, made on first use; callers that arrive while it is being made wait for it
+    if DBStr not in _engines:
+        if DBStr not in _starting:
+            _starting[DBStr] = asyncio.ensure_future(_StartEngine(DBStr))
+        try:
+            await _starting[DBStr]
+        finally:
+            _starting.pop(DBStr, None)
+    return _engines[DBStr]
+
+
+async def DisposeEngine(DBStr=None):
+    # close pooled connections for one database, or for every database if DBStr is None
+    keys = list(_engines) if DBStr is None else [key for key in [DBStr] if key in _engines]
+    for key in keys:
+        _session_factories.pop(key)
+        await _engines.pop(key).dispose()
+
+
+async def _Run(DBStr, fn, *args, **kwargs):
+    # DBlib's fn on a session of its own from the shared pool, committed when fn returns
+    await GetEngine(DBStr)
+    async with _session_factories[DBStr]() as s:
+        async with s.begin():
+            return await s.run_sync(lambda sync_session: fn(DBStr, *args, thisSession=sync_session, **kwargs))
+
+
+async def AddToDb(DBStr=None, thisDataFile=None, unusedDataFlag=True, AlgPars=None, thisEvent=None,
+                  thisCompoundAnimal=None, thisChannel=None, onConflict=None):
+    return await _Run(DBStr, DBlib.AddToDb, thisDataFile=thisDataFile, unusedDataFlag=unusedDataFlag, AlgPars=AlgPars,
+                      thisEvent=thisEvent, thisCompoundAnimal=thisCompoundAnimal, thisChannel=thisChannel,
+                      onConflict=onConflict)
+
+
+async def FindInDb(DBStr=None, thisTable=None, thisFilename=None, unusedDataFlag=True, thisAnimal=None,
+                   thisCompoundAnimal=None):
+    # an open DBlib snapshot answers straight from memory, without touching the pool
+    entry_query = DBlib._FindInSnapshot(DBStr, thisTable, thisFilename, thisAnimal, thisCompoundAnimal)
+    if entry_query is not None:
+        return entry_query
+    return await _Run(DBStr, DBlib.FindInDb, thisTable, thisFilename, unusedDataFlag, thisAnimal, thisCompoundAnimal)
+
+
+async def GetAllSeizures(DBStr=None, this_animal_name=None):
+    all_szrs = DBlib._SnapshotRows(DBStr, DBlib.Events, 'animal', this_animal_name)
+    if all_szrs is not None:
+        return all_szrs
+    return await _Run(DBStr, DBlib.GetAllSeizures, this_animal_name)
+
+
+async def GetDistinctValues(DBStr=None, TableName=None, ColName=None):
+    return await _Run(DBStr, DBlib.GetDistinctValues, TableName, ColName)
+
+
+async def UpdateDb(DBStr=None, thisDataFile=None, unusedDataFlag=True, thisAnimal=None, thisVideoPath=None,
+                   fileReviewed=None):
+    return await _Run(DBStr, DBlib.UpdateDb, thisDataFile, unusedDataFlag, thisAnimal, thisVideoPath, fileReviewed)
+
+
+async def RemoveFromDb(DBStr=None, thisTable=None, thisFileName=None, thisAnimalName=None, thisDataFile=None,
+                       unusedDataFlag=True, AlgPars=None, thisEvent=None):
+    return await _Run(DBStr, DBlib.RemoveFromDb, thisTable, thisFileName, thisAnimalName, thisDataFile,
+                      unusedDataFlag, AlgPars, thisEvent)
@@ -0,0 +1,381 @@
+# Benchmarks for DBlib.
+#
+#     python DBlib_bench.py [--db DBStr] [--animals N] [--files N] [--channels N] [--events N]
+#                           [--repeats N] [--output results.json]
+#
+# Without --db a synthetic database is built in a temporary file; an SQLite --db is copied to one, so
+# the cases never write to the real database. Every public DBlib function is timed against it and
+# latency percentiles plus rows/s are written as JSON, so runs from different commits can be compared
+# directly.
+import argparse
+import collections
+import datetime
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import sqlalchemy
+
+import DBlib
+
+ChanData = collections.namedtuple('ChanData', 'name idx number sample_freq file_length file_start')
+EventData = collections.namedtuple('EventData', 'Animal FileName Start End Description RacineScore Event HowFound')
+
+
+def ChannelName(animal, channel):
+    return 'animal%02d_ch%02d' % (animal, channel)
+
+
+def MakeSyntheticDb(DBStr, n_animals=4, files_per_animal=24, events_per_file=200, channels_per_file=1,
+                    file_length=3600, seed=0):
+    # Each animal is a compound animal in AnimalChannelList recorded on channels_per_file channels.
+    # Every channel has one hour-long DataFiles row per file, with short events scattered through it.
+    # Each file also carries one unused channel in unusedDataFiles. Returns the number of events
+    rng = random.Random(seed)
+    start = datetime.datetime(2020, 1, 1)
+    events = []
+    with DBlib.DbSession(DBStr) as s:
+        for a in range(n_animals):
+            for c in range(channels_per_file):
+                s.add(DBlib.AnimalChannelList(compound_animal='animal%02d' % a, channel=ChannelName(a, c)))
+                s.add(DBlib.AlgorithmParameters(ChannelName(a, c)))
+            for f in range(files_per_animal):
+                fname = '/data/animal%02d_%04d.smr' % (a, f)
+                file_start = start + datetime.timedelta(seconds=f * file_length)
+                for c in range(channels_per_file + 1):
+                    table = DBlib.DataFiles if c < channels_per_file else DBlib.unusedDataFiles
+                    s.add(table(animal=ChannelName(a, c), file_name=os.path.basename(fname), file_path='/data',
+                                file_start=file_start, chan_number=c, chan_idx=c, sample_freq=500,
+                                file_length=file_length))
+                for c in range(channels_per_file):
+                    for e in range(events_per_file):
+                        ev_start = rng.uniform(0, file_length - 60)
+                        events.append(EventData(ChannelName(a, c), fname, ev_start, ev_start + rng.uniform(1, 60),
+                                                '', rng.randint(0, 5), 'seizure', 'auto'))
+    DBlib.AddEvents(DBStr, events, onConflict='ignore')
+    return len(events)
+
+
+def _Count(result):
+    if result is None or isinstance(result, bool):
+        return 1
+    if isinstance(result, (int, long)):
+        return result
+    if isinstance(result, dict) and result and all(isinstance(v, (int, long)) for v in result.values()):
+        return sum(result.values())
+    try:
+        return len(result)
+    except TypeError:
+        return sum(1 for row in result)
+
+
+def _Percentile(sorted_times, pct):
+    return sorted_times[min(len(sorted_times) - 1, int(round(pct / 100.0 * (len(sorted_times) - 1))))]
+
+
+def TimeCase(fn, repeats, setup=None):
+    # fn(i) is called repeats times; rows are whatever it returns (length, count or 1 per call)
+    times = []
+    rows = 0
+    for i in range(repeats):
+        if setup is not None:
+            setup(i)
+        t0 = time.time()
+        rows += _Count(fn(i))
+        times.append(time.time() - t0)
+    times.sort()
+    total = sum(times)
+    return {'calls': repeats,
+            'rows': rows,
+            'mean_ms': 1000 * total / repeats,
+            'p50_ms': 1000 * _Percentile(times, 50),
+            'p90_ms': 1000 * _Percentile(times, 90),
+            'p99_ms': 1000 * _Percentile(times, 99),
+            'max_ms': 1000 * times[-1],
+            'rows_per_s': rows / total if total > 0 else None}
+
+
+def BenchWindowQueries(DBStr, thisAnimal=None, n_windows=50, window_len=600, seed=0):
+    # indexed FindEventsOverlapping against pulling everything with GetAllSeizures and filtering in Python
+    rng = random.Random(seed)
+    if thisAnimal is None:
+        thisAnimal = sorted(DBlib.GetDistinctValues(DBStr, 'DataFiles', 'animal'))[0]
+    files = DBlib.GetAllFiles(DBStr, thisAnimal)
+    t_min = min(f.file_start for f in files)
+    t_max = max(f.file_start for f in files) + datetime.timedelta(seconds=files[0].file_length)
+    span = (t_max - t_min).total_seconds() - window_len
+    windows = [t_min + datetime.timedelta(seconds=rng.uniform(0, span)) for i in range(n_windows)]
+
+    def indexed(i):
+        return DBlib.FindEventsOverlapping(DBStr, thisAnimal, windows[i],
+                                           windows[i] + datetime.timedelta(seconds=window_len))
+
+    def scan_and_filter(i):
+        t0 = windows[i]
+        t1 = t0 + datetime.timedelta(seconds=window_len)
+        return [e for e in DBlib.GetAllSeizures(DBStr, thisAnimal)
+                if e.file_start + datetime.timedelta(seconds=e.event_start) <= t1 and
+                e.file_start + datetime.timedelta(seconds=e.event_end) >= t0]
+
+    for i in range(n_windows):
+        assert len(indexed(i)) == len(scan_and_filter(i))
+    return {'FindEventsOverlapping': TimeCase(indexed, n_windows),
+            'GetAllSeizures + filter': TimeCase(scan_and_filter, n_windows)}
+
+
+def BenchPublicFunctions(DBStr, repeats=20, seed=0):
+    # one timed case per public DBlib call, using names drawn from the database itself. Writes are
+    # undone within the run (added events removed, review flags restored, moved animals moved back)
+    # so cases stay repeatable
+    rng = random.Random(seed)
+    channels = sorted(DBlib.GetDistinctValues(DBStr, 'DataFiles', 'animal'))
+    unused = sorted(DBlib.GetDistinctValues(DBStr, 'unusedDataFiles', 'animal'))
+    files = sorted(DBlib.GetDistinctValues(DBStr, 'DataFiles', 'file_name'))
+    compound = sorted(DBlib.GetDistinctValues(DBStr, 'AnimalChannelList', 'compound_animal'))
+    pick = lambda values, i: values[i % len(values)]
+    channel_files = dict((ch, [f.file_name for f in DBlib.GetAllFiles(DBStr, ch)]) for ch in channels)
+
+    def new_event(i, offset=0):
+        ch = pick(channels, i)
+        return EventData(ch, '/data/' + pick(channel_files[ch], i), 5000.0 + i + offset, 5001.0 + i + offset, '', 0,
+                         'seizure', 'bench')
+
+    def existing_keys(i, n):
+        ch = pick(channels, i)
+        szrs = DBlib.IterAllSeizures(DBStr, ch, columns=['animal', 'filename', 'event_start'])
+        return [tuple(row) for row, k in zip(szrs, range(n))]
+
+    def window(i):
+        ch = pick(channels, i)
+        fs = DBlib.GetAllFiles(DBStr, ch)
+        t0 = pick(fs, i).file_start + datetime.timedelta(seconds=rng.uniform(0, 3000))
+        return ch, t0, t0 + datetime.timedelta(seconds=600)
+
+    results = collections.OrderedDict()
+    results['AddToDb event'] = TimeCase(lambda i: DBlib.AddToDb(DBStr, thisEvent=new_event(i)), repeats)
+    results['EntryExists event'] = TimeCase(lambda i: DBlib.EntryExists(DBStr, thisEvent=new_event(i)), repeats)
+
+    def remove_event(i):
+        # RemoveFromDb hands back the (already executed) delete query; count one row per call
+        DBlib.RemoveFromDb(DBStr, thisEvent=new_event(i))
+    results['RemoveFromDb event'] = TimeCase(remove_event, repeats)
+    results['AddEvents 1000'] = TimeCase(
+        lambda i: DBlib.AddEvents(DBStr, [new_event(i, 10000 * (j + 1)) for j in range(1000)]), repeats)
+    results['AddEvents 1000 ignore'] = TimeCase(
+        lambda i: DBlib.AddEvents(DBStr, [new_event(i, 10000 * (j + 1)) for j in range(1000)], onConflict='ignore'),
+        repeats)
+
+    def writer_batch(i):
+        # a detector handing a newly registered file to the DbWriter together with its events
+        ch = pick(channels, i)
+        fname = '/data/bench_%04d.smr' % i
+        ack = writer_client.Wait(writer_client.Submit(
+            [EventData(ch, fname, 10.0 + j, 11.0 + j, '', 0, 'seizure', 'bench') for j in range(100)],
+            dataFiles=[(fname, ChanData(ch, 0, 0, 500, 3600, (2020, 1, 1, 0, 0, 0)))], unusedDataFlag=False))
+        assert ack['error'] is None
+        return ack['events']
+    with DBlib.DbWriter(DBStr, flushInterval=0.01) as writer:
+        writer_client = writer.Client()
+        results['DbWriter file + 100 events'] = TimeCase(writer_batch, repeats)
+    with DBlib.DbSession(DBStr) as s:
+        # every event written above has a file, so each must have been placed on the absolute clock
+        bench_events = s.query(DBlib.Events).filter(DBlib.Events.how_found == 'bench')
+        assert bench_events.filter(DBlib.Events.abs_start == None).count() == 0
+        bench_events.delete(synchronize_session=False)
+        s.query(DBlib.DataFiles).filter(DBlib.DataFiles.file_name.like('bench_%')).delete(synchronize_session=False)
+
+    key_sets = [existing_keys(i, 500) for i in range(repeats)]
+    results['EntriesExist 500'] = TimeCase(lambda i: DBlib.EntriesExist(DBStr, 'Events', key_sets[i]), repeats)
+    results['EntryExists filename'] = TimeCase(
+        lambda i: DBlib.EntryExists(DBStr, thisFileName=pick(files, i), unusedDataFlag=False), repeats)
+    results['FindInDb Events'] = TimeCase(
+        lambda i: DBlib.FindInDb(DBStr, 'Events', pick(channel_files[pick(channels, i)], i), thisAnimal=pick(channels, i)),
+        repeats)
+    results['FindInDb DataFiles'] = TimeCase(
+        lambda i: DBlib.FindInDb(DBStr, 'DataFiles', pick(channel_files[pick(channels, i)], i), thisAnimal=pick(channels, i)),
+        repeats)
+    results['FindInDb AnimalChannelList'] = TimeCase(
+        lambda i: DBlib.FindInDb(DBStr, 'AnimalChannelList', thisCompoundAnimal=pick(compound, i)), repeats)
+    results['GetDistinctValues cold'] = TimeCase(lambda i: DBlib.GetDistinctValues(DBStr, 'DataFiles', 'file_name'),
+                                                 repeats, setup=lambda i: DBlib.InvalidateCache(DBStr))
+    results['GetDistinctValues cached'] = TimeCase(lambda i: DBlib.GetDistinctValues(DBStr, 'DataFiles', 'file_name'),
+                                                   repeats)
+    results['MakeAnimalChanDict cold'] = TimeCase(lambda i: DBlib.MakeAnimalChanDict(DBStr), repeats,
+                                                  setup=lambda i: DBlib.InvalidateCache(DBStr))
+    results['GetAllSeizures'] = TimeCase(lambda i: DBlib.GetAllSeizures(DBStr, pick(channels, i)), repeats)
+    results['IterAllSeizures'] = TimeCase(
+        lambda i: DBlib.IterAllSeizures(DBStr, pick(channels, i), columns=['event_start', 'event_end']), repeats)
+    results['GetAllFiles'] = TimeCase(lambda i: DBlib.GetAllFiles(DBStr, pick(channels, i)), repeats)
+    results['GetAllChans'] = TimeCase(lambda i: DBlib.GetAllChans(DBStr, pick(files, i)), repeats)
+    windows = [window(i) for i in range(repeats)]
+    results['FindEventsOverlapping'] = TimeCase(lambda i: DBlib.FindEventsOverlapping(DBStr, *windows[i]), repeats)
+    results['FindEventsWithin'] = TimeCase(lambda i: DBlib.FindEventsWithin(DBStr, *windows[i]), repeats)
+    results['FindNearestEvent'] = TimeCase(lambda i: DBlib.FindNearestEvent(DBStr, windows[i][0], windows[i][1]),
+                                           repeats)
+    results['ExportColumns Events'] = TimeCase(lambda i: DBlib.ExportColumns(DBStr, 'Events', pick(channels, i)),
+                                               repeats)
+    reviewed_keys = [(pick(channels, i), pick(channel_files[pick(channels, i)], i)) for i in range(repeats)]
+    reviewed_before = dict(((f.animal, f.file_name), f.reviewed) for ch, fname in set(reviewed_keys)
+                           for f in DBlib.FindInDb(DBStr, 'DataFiles', fname, thisAnimal=ch))
+    results['UpdateDb reviewed'] = TimeCase(
+        lambda i: DBlib.UpdateDb(DBStr, thisDataFile=reviewed_keys[i][1], thisAnimal=reviewed_keys[i][0],
+                                 fileReviewed=bool(i % 2)), repeats)
+    DBlib.UpdateDataFiles(DBStr, dict((key, {'reviewed': flag}) for key, flag in reviewed_before.items()))
+    results['MoveAnimals'] = TimeCase(
+        lambda i: DBlib.MoveAnimals(DBStr, 'unusedDataFiles' if i % 2 == 0 else 'DataFiles', thisAnimal=pick(unused, i // 2)),
+        repeats - repeats % 2)
+    return results
+
+
+def _Latencies(times):
+    times = sorted(times)
+    if not times:
+        return {'ops': 0}
+    return {'ops': len(times),
+            'p50_ms': 1000 * _Percentile(times, 50),
+            'p99_ms': 1000 * _Percentile(times, 99),
+            'max_ms': 1000 * times[-1]}
+
+
+def _ConcurrentWorker(role, DBStr, profile, stop_at, channel, results):
+    # one process of the concurrency benchmark: the writer appends small event batches the way a
+    # detector does, readers poll the query functions the way the review GUI does
+    DBlib.DisposeEngine()
+    if profile is not None:
+        DBlib.SetConnectionProfile(DBStr, profile)
+    files = [f.file_name for f in DBlib.GetAllFiles(DBStr, channel)]
+    times = []
+    errors = 0
+    i = 0
+    while time.time() < stop_at:
+        t0 = time.time()
+        try:
+            if role == 'writer':
+                DBlib.AddEvents(DBStr, [EventData(channel, '/data/' + files[i % len(files)], 100000.0 + 50 * i + j,
+                                                  100001.0 + 50 * i + j, '', 0, 'seizure', 'bench')
+                                        for j in range(50)], onConflict='ignore')
+            elif i % 2:
+                DBlib.GetAllSeizures(DBStr, channel)
+            else:
+                DBlib.FindInDb(DBStr, 'Events', files[i % len(files)], thisAnimal=channel)
+            times.append(time.time() - t0)
+        except sqlalchemy.exc.OperationalError:
+            errors += 1
+        i += 1
+    stats = _Latencies(times)
+    stats['errors'] = errors
+    results.put((role, stats))
+
+
+def BenchConcurrency(DBStr, n_readers=3, duration_s=5.0):
+    # one writer process and n_readers reader processes on the same SQLite file, first with the
+    # driver defaults and then with CONCURRENT_PROFILE. Each run gets its own copy of the database
+    # because WAL mode, once set, is stored in the file
+    src_path = sqlalchemy.engine.url.make_url(DBStr).database
+    channels = sorted(DBlib.GetDistinctValues(DBStr, 'DataFiles', 'animal'))
+    DBlib.DisposeEngine()
+    report = collections.OrderedDict()
+    for label, profile in (('default', None), ('concurrent', DBlib.CONCURRENT_PROFILE)):
+        work_dir = tempfile.mkdtemp()
+        run_path = os.path.join(work_dir, 'concurrency.db')
+        shutil.copy(src_path, run_path)
+        run_db = 'sqlite:///' + run_path
+        results = multiprocessing.Queue()
+        stop_at = time.time() + duration_s
+        workers = [multiprocessing.Process(target=_ConcurrentWorker,
+                                           args=('writer', run_db, profile, stop_at, channels[0], results))]
+        workers += [multiprocessing.Process(target=_ConcurrentWorker,
+                                            args=('reader', run_db, profile, stop_at, channels[(r + 1) % len(channels)],
+                                                  results))
+                    for r in range(n_readers)]
+        for worker in workers:
+            worker.start()
+        outcome = [results.get() for worker in workers]
+        for worker in workers:
+            worker.join()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+        writer = [stats for role, stats in outcome if role == 'writer'][0]
+        readers = [stats for role, stats in outcome if role == 'reader']
+        report[label] = {'writer': writer,
+                         'writer_ops_per_s': writer['ops'] / duration_s,
+                         'reader_ops_per_s': sum(stats['ops'] for stats in readers) / duration_s,
+                         'reader_errors': sum(stats['errors'] for stats in readers),
+                         'reader_p99_ms': max(stats.get('p99_ms', 0) for stats in readers)}
+    return report
+
+
+def RunBenchmarks(DBStr=None, n_animals=4, files_per_animal=24, channels_per_file=2, events_per_file=100,
+                  repeats=20, seed=0, concurrency_s=0, n_readers=3):
+    config = {'animals': n_animals, 'files_per_animal': files_per_animal, 'channels_per_file': channels_per_file,
+              'events_per_file': events_per_file, 'repeats': repeats, 'seed': seed, 'concurrency_s': concurrency_s,
+              'readers': n_readers}
+    config['db'] = DBStr
+    copy_dir = None
+    if DBStr is None:
+        DBStr = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'dblib_bench.db')
+        t0 = time.time()
+        n_events = MakeSyntheticDb(DBStr, n_animals, files_per_animal, events_per_file, channels_per_file, seed=seed)
+        config['build_s'] = time.time() - t0
+        config['events'] = n_events
+        config['db'] = DBStr
+    elif DBlib._IsSqliteFile(DBStr):
+        # the cases (and MigrateIndexes) write, so they get a copy; the -wal file holds the latest commits
+        src_path = sqlalchemy.engine.url.make_url(DBStr).database
+        copy_dir = tempfile.mkdtemp()
+        run_path = os.path.join(copy_dir, 'dblib_bench.db')
+        for suffix in ('', '-wal'):
+            if os.path.exists(src_path + suffix):
+                shutil.copy(src_path + suffix, run_path + suffix)
+        DBStr = 'sqlite:///' + run_path
+
+    try:
+        DBlib.MigrateIndexes(DBStr)
+        results = BenchPublicFunctions(DBStr, repeats, seed)
+        for name, stats in BenchWindowQueries(DBStr, n_windows=repeats, seed=seed).items():
+            results['window query: ' + name] = stats
+        report = {'config': config,
+                  'sqlalchemy': sqlalchemy.__version__,
+                  'python': sys.version.split()[0],
+                  'results': results}
+        if concurrency_s > 0:
+            report['concurrency'] = BenchConcurrency(DBStr, n_readers, concurrency_s)
+    finally:
+        if copy_dir is not None:
+            DBlib.DisposeEngine(DBStr)
+            shutil.rmtree(copy_dir, ignore_errors=True)
+    return report
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Time the public DBlib functions.')
+    parser.add_argument('--db', help='existing database to benchmark instead of a synthetic one (SQLite files are '
+                                     'copied first, so they are never written to)')
+    parser.add_argument('--animals', type=int, default=4)
+    parser.add_argument('--files', type=int, default=24, help='files per animal')
+    parser.add_argument('--channels', type=int, default=2, help='channels per file')
+    parser.add_argument('--events', type=int, default=100, help='events per channel per file')
+    parser.add_argument('--repeats', type=int, default=20, help='calls per timed case')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--concurrency', type=float, default=0,
+                        help='seconds to run the concurrent reader/writer comparison for (0 skips it)')
+    parser.add_argument('--readers', type=int, default=3, help='reader processes in the concurrency run')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args(argv[1:])
+
+    report = RunBenchmarks(args.db, args.animals, args.files, args.channels, args.events, args.repeats, args.seed,
+                           args.concurrency, args.readers)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print json.dumps(report, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv)